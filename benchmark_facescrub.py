@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script is released under a Creative Commons Attribution-NonCommercial 4.0 International Public License.
+To view a copy of this license, visit <http://creativecommons.org/licenses/by-nc/4.0/legalcode>
+
+File: benchmark_facescrub.py
+Description: Benchmark python3_download_facescrub.py against a local fake image server
+
+The benchmark starts one local HTTP server per fake host, each serving synthetic
+JPEG images with configurable latency, error rate, redirects, wrong content-types
+and wrong hashes. It writes a matching FaceScrub data file, runs the downloader on
+it in a separate process and reports images/sec, bytes/sec, p50/p99 download
+latency, peak RSS and CPU time per image. No network access is needed.
+
+# Requirements:
+Same as python3_download_facescrub.py
+
+# Example
+
+>>> # Default settings: 500 images on 10 hosts, 50 ms mean latency
+>>> python benchmark_facescrub.py
+
+>>> # Arguments after -- are passed to the downloader
+>>> python benchmark_facescrub.py --images=2000 --hosts=50 -- --engine=asyncio --concurrency=200 --rate_per_host=0
+
+>>> # Compare thread counts and keep the results as JSON
+>>> python benchmark_facescrub.py --json=n10.json -- -n 10
+>>> python benchmark_facescrub.py --json=n40.json -- -n 40
+
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import resource
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.server
+
+from PIL import Image
+
+
+def make_image(rng, size):
+    """Returns a synthetic JPEG image as bytes"""
+
+    I = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    # A few random blocks so that images differ in content and compress like photos
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        block = Image.effect_noise((max(1, size[0] // 8), max(1, size[1] // 8)), rng.randrange(10, 100))
+        I.paste(block.convert("RGB"), (x, y))
+    buf = io.BytesIO()
+    I.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+class FakeImageServer(object):
+    """Local HTTP server that serves synthetic images
+
+    Paths are /<kind>/<number>.jpg where kind is one of
+    img (the image), redirect (302 to the image), html (wrong content-type)
+    and missing (404). Every response is delayed by a random latency with
+    the given mean, in seconds.
+
+    """
+
+    def __init__(self, images, latency):
+        self.images = images
+        self.latency = latency
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def make_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Allow keep-alive
+
+            def send(self, code, body=b"", content_type="image/jpeg", headers=()):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.bytes_sent += len(body)
+
+            def do_GET(self):
+                if server.latency > 0:
+                    time.sleep(random.expovariate(1.0 / server.latency))
+
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 2 or not parts[1].endswith(".jpg"):
+                    return self.send(404, content_type="text/plain")
+                kind, number = parts[0], int(parts[1][:-len(".jpg")])
+
+                if kind == "img":
+                    self.send(200, server.images[number])
+                elif kind == "redirect":
+                    self.send(302, content_type="text/plain", headers=[("Location", "/img/{}.jpg".format(number))])
+                elif kind == "html":
+                    self.send(200, b"<html><body>Not an image</body></html>", content_type="text/html")
+                else:
+                    self.send(404, content_type="text/plain")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def write_data_file(path, images, ports, args, rng):
+    """Write a FaceScrub data file for the fake servers. Returns the number of lines (excluding header)"""
+
+    lines = 0
+    with open(path, 'w') as outfile:
+        outfile.write("name\timage_id\tface_id\turl\tbbox\tsha256\n")
+        face_id = 0
+        for image_id, content in enumerate(images):
+            sha256 = hashlib.sha256(content).hexdigest()
+            p = rng.random()
+            if p < args.error_rate:
+                kind = "missing"
+            elif p < args.error_rate + args.wrong_type_rate:
+                kind = "html"
+            elif p < args.error_rate + args.wrong_type_rate + args.redirect_rate:
+                kind = "redirect"
+            else:
+                kind = "img"
+            if rng.random() < args.wrong_hash_rate:
+                sha256 = hashlib.sha256(sha256.encode("ascii")).hexdigest()
+
+            url = "http://127.0.0.1:{port}/{kind}/{number}.jpg".format(port=rng.choice(ports), kind=kind, number=image_id)
+            name = "Person {}".format(image_id % args.names)
+            for _ in range(args.faces_per_image):
+                face_id += 1
+                x, y = rng.randrange(args.width // 2), rng.randrange(args.height // 2)
+                bbox = "{},{},{},{}".format(x, y, x + args.width // 4, y + args.height // 4)
+                outfile.write("\t".join([name, str(image_id), str(face_id), url, bbox, sha256]) + "\n")
+                lines += 1
+    return lines
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of values, or 0 if there are none"""
+
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def run_client(stats_path, argv):
+    """Run the downloader in this process and write timing statistics to stats_path as JSON"""
+
+    import python3_download_facescrub as downloader
+
+    latencies = []
+    download_image = downloader.download_image
+    download_image_async = downloader.download_image_async
+
+    def timed_download_image(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return download_image(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def timed_download_image_async(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await download_image_async(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    downloader.download_image = timed_download_image
+    downloader.download_image_async = timed_download_image_async
+
+    start = time.perf_counter()
+    results = downloader.main(argv) or {}
+    elapsed = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)  # Crop workers
+    stats = {"elapsed": elapsed,
+             "saved": results.get("saved", 0),
+             "failed": results.get("failed", 0),
+             "latencies": latencies,
+             "cpu": usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime,
+             "max_rss_kb": usage.ru_maxrss}
+    with open(stats_path, 'w') as outfile:
+        json.dump(stats, outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark python3_download_facescrub.py against a local fake image server",
+                                     epilog="Arguments after -- are passed to python3_download_facescrub.py")
+    parser.add_argument('--images', type=int, help="Number of distinct images", action="store", required=False, dest="images", default=500)
+    parser.add_argument('--faces_per_image', type=int, help="Number of data file lines (faces) per image", action="store", required=False,
+                        dest="faces_per_image", default=1)
+    parser.add_argument('--names', type=int, help="Number of distinct celebrity names", action="store", required=False, dest="names", default=50)
+    parser.add_argument('--hosts', type=int, help="Number of fake hosts (one server port each)", action="store", required=False, dest="hosts", default=10)
+    parser.add_argument('--width', type=int, help="Width of images in pixels", action="store", required=False, dest="width", default=640)
+    parser.add_argument('--height', type=int, help="Height of images in pixels", action="store", required=False, dest="height", default=480)
+    parser.add_argument('--latency', type=float, help="Mean latency of the servers in milliseconds (float)", action="store", required=False,
+                        dest="latency", default=50)
+    parser.add_argument('--error_rate', type=float, help="Fraction of images that return 404", action="store", required=False,
+                        dest="error_rate", default=0.05)
+    parser.add_argument('--redirect_rate', type=float, help="Fraction of images served through a redirect", action="store", required=False,
+                        dest="redirect_rate", default=0.1)
+    parser.add_argument('--wrong_type_rate', type=float, help="Fraction of images that return HTML instead of an image", action="store",
+                        required=False, dest="wrong_type_rate", default=0.02)
+    parser.add_argument('--wrong_hash_rate', type=float, help="Fraction of lines with a sha256 that does not match the image", action="store",
+                        required=False, dest="wrong_hash_rate", default=0.02)
+    parser.add_argument('--seed', type=int, help="Random seed for generating the data", action="store", required=False, dest="seed", default=0)
+    parser.add_argument('--json', type=str, help="Also write the results to this file as JSON", action="store", required=False, dest="json")
+    parser.add_argument('--keep_output', help="Keep the generated data file, log and downloaded images", dest="keep_output",
+                        action="store_true", default=False)
+    parser.add_argument('-v', '--verbose', help="Show the downloader's log output", dest="verbose", action="store_true", default=False)
+    parser.add_argument('--client', help=argparse.SUPPRESS, dest="client", action="store", default=None)
+
+    argv = sys.argv[1:]
+    downloader_argv = []
+    if "--" in argv:
+        downloader_argv = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+
+    # Internal: this process is the downloader started below
+    if args.client is not None:
+        run_client(args.client, downloader_argv)
+        return
+
+    assert args.images >= 1, "images must be >= 1"
+    assert args.faces_per_image >= 1, "faces_per_image must be >= 1"
+    assert args.names >= 1, "names must be >= 1"
+    assert args.hosts >= 1, "hosts must be >= 1"
+    assert args.width >= 4 and args.height >= 4, "width and height must be >= 4"
+    assert args.latency >= 0, "latency must be >= 0"
+    assert args.error_rate + args.redirect_rate + args.wrong_type_rate <= 1, "error, redirect and wrong type rates must add up to <= 1"
+
+    rng = random.Random(args.seed)
+    print("Generating {} images".format(args.images))
+    images = [make_image(rng, (args.width, args.height)) for _ in range(args.images)]
+
+    servers = [FakeImageServer(images, args.latency / 1000.0) for _ in range(args.hosts)]
+    for server in servers:
+        server.start()
+
+    workdir = tempfile.mkdtemp(prefix="facescrub_benchmark_")
+    datafile = os.path.join(workdir, "data.txt")
+    datasetpath = os.path.join(workdir, "dataset")
+    stats_path = os.path.join(workdir, "stats.json")
+    lines = write_data_file(datafile, images, [server.port for server in servers], args, rng)
+
+    command = [sys.executable, os.path.abspath(__file__), "--client", stats_path, "--",
+               datafile, datasetpath, "--logfile", os.path.join(workdir, "download.log")] + downloader_argv
+    print("Running downloader on {} lines: {}".format(lines, " ".join(downloader_argv)))
+    try:
+        output = None if args.verbose else subprocess.DEVNULL
+        subprocess.check_call(command, stdout=output, stderr=output,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        for server in servers:
+            server.stop()
+
+    with open(stats_path) as infile:
+        stats = json.load(infile)
+
+    elapsed = stats["elapsed"]
+    bytes_sent = sum(server.bytes_sent for server in servers)
+    results = {"lines": lines,
+               "images_saved": stats["saved"],
+               "images_failed": stats["failed"],
+               "seconds": elapsed,
+               "images_per_sec": stats["saved"] / elapsed,
+               "bytes_per_sec": bytes_sent / elapsed,
+               "latency_p50_ms": percentile(stats["latencies"], 50) * 1000,
+               "latency_p99_ms": percentile(stats["latencies"], 99) * 1000,
+               "peak_rss_mb": stats["max_rss_kb"] / 1024.0,
+               "cpu_ms_per_image": stats["cpu"] * 1000 / max(1, stats["saved"]),
+               "downloader_args": downloader_argv}
+
+    print("")
+    print('=' * 30)
+    print("Images saved:     {} ({} failed)".format(results["images_saved"], results["images_failed"]))
+    print("Time:             {:.2f} s".format(results["seconds"]))
+    print("Images/sec:       {:.1f}".format(results["images_per_sec"]))
+    print("MB/sec:           {:.2f}".format(results["bytes_per_sec"] / 1024.0 / 1024.0))
+    print("Latency p50/p99:  {:.1f} / {:.1f} ms".format(results["latency_p50_ms"], results["latency_p99_ms"]))
+    print("Peak RSS:         {:.1f} MB".format(results["peak_rss_mb"]))
+    print("CPU per image:    {:.2f} ms".format(results["cpu_ms_per_image"]))
+    if args.keep_output:
+        print("Output:           {}".format(workdir))
+    print('=' * 30)
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+    if not args.keep_output:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,9 @@ pip install Pillow
 # Optional, but good to have, for detecting file type. May not work on Windows
 pip install python-magic
 
+# Optional, only needed for --engine=asyncio
+pip install aiohttp
+
 # Steps to download FaceScrub dataset
 1. First, obtain the FaceScrub files containing links to the images from http://vintage.winklerbros.net/facescrub.html
 2. Next, set MY_USER_AGENT_STRING below. You can obtain it by visiting a site such as https://www.whatismybrowser.com/detect/what-is-my-user-agent
@@ -43,20 +46,47 @@ Note: actors_users_normal_bbox.txt is obtained from the above link.
 >>> python python3_download_facescrub.py actors_users_normal_bbox.txt actors/ \
     --crop_face --logfile=download.log --timeout=10 --max_retries=3 --start_at_line=10 --end_at_line=20
 
+>>> # Use a single event loop with many concurrent downloads instead of threads
+>>> python python3_download_facescrub.py actors_users_normal_bbox.txt actors/ --engine=asyncio --concurrency=500
+
 The above code will save full size images to the directory actors/images and faces (if required) to actors/faces
 
 """
 
 import os
+import sys
 import shutil
 import mimetypes
 import logging
+import logging.handlers
+import queue
+import atexit
+import json
 import urllib.parse
 import hashlib
 import argparse
+import collections
+import asyncio
+import threading
+import time
+import tempfile
+import sqlite3
+import tarfile
+import mmap
+import io
+import struct
+import math
+import functools
+import re
+import array
+import socket
+import zlib
+import heapq
+import random
+import datetime
+import email.utils
 from itertools import islice
 
-import imghdr
 try:
     import magic
     has_magic_lib = True
@@ -70,40 +100,362 @@ from requests import TooManyRedirects
 from requests import Timeout
 from requests import HTTPError
 from requests import RequestException
+import urllib3
+from urllib3.util.retry import Retry
 
 import concurrent.futures
+import multiprocessing
+
+try:
+    import aiohttp
+    has_aiohttp_lib = True
+except ImportError as e:
+    has_aiohttp_lib = False
 
 # Visit website and copy user agent string as single line https://www.whatismybrowser.com/detect/what-is-my-user-agent
 MY_USER_AGENT_STRING="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/47.0.2526.106 Chrome/47.0.2526.106 Safari/537.36"
 
 session = None
 
-def setup_session(max_retries=1):
+def setup_session(max_retries=1, pool_hosts=10, pool_size=10):
     # Use a `Session` instance to customize how `requests` handles making HTTP requests.
+    # The session and its connection pools are shared by all download threads.
     global session
     session = requests.Session()
 
     # `mount` a custom adapter that retries failed connections for HTTP and HTTPS requests.
-    session.mount("http://", requests.adapters.HTTPAdapter(max_retries=max_retries))
-    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=max_retries))
+    # Retry-After is left to HostScheduler so that workers never sleep waiting for a server.
+    # Keep-alive connections are kept for up to pool_hosts hosts, and up to pool_size per host.
+    retries = Retry(total=max_retries, read=False, respect_retry_after_header=False)
+    session.mount("http://", CountingHTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retries))
+    session.mount("https://", CountingHTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retries))
+
+
+class CountConnections(object):
+    """Mixin for urllib3 connections that counts every time one connects in metrics"""
+
+    def connect(self):
+        metrics.inc("connections_total")
+        return super(CountConnections, self).connect()
+
+
+class CountingHTTPConnection(CountConnections, urllib3.connection.HTTPConnection):
+    pass
+
+
+class CountingHTTPSConnection(CountConnections, urllib3.connection.HTTPSConnection):
+    pass
+
 
+class CountingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connection pools count the connections they open, to see how many requests reuse one"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+
+class DnsCache(object):
+    """Cache of socket.getaddrinfo results, kept for ttl seconds
+
+    install makes every host name lookup of the process go through the cache,
+    so that connections to the same host do not each wait for a DNS query,
+    until uninstall. Safe to use from several threads.
+
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # getaddrinfo arguments -> (expiry time, result)
+        self.getaddrinfo = socket.getaddrinfo
+        if isinstance(self.getaddrinfo, DnsCache):  # Never cache a cache
+            self.getaddrinfo = self.getaddrinfo.getaddrinfo
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            metrics.inc("dns_lookups_total", cached="yes")
+            return entry[1]
+
+        result = self.getaddrinfo(*args, **kwargs)
+        metrics.inc("dns_lookups_total", cached="no")
+        with self.lock:
+            self.entries[key] = (now + self.ttl, result)
+        return result
+
+    def install(self):
+        socket.getaddrinfo = self
+
+    def uninstall(self):
+        if socket.getaddrinfo is self:
+            socket.getaddrinfo = self.getaddrinfo
+
+
+class Metrics(object):
+    """Counters, gauges and histograms of the current run. Safe to use from several threads.
+
+    Metrics are named without prefix and may have labels, e.g.
+    metrics.inc("downloads_total", status="timeout"). Gauges can also be read
+    from a function when reported. prometheus returns all metrics in the
+    Prometheus text format and summary returns a one line progress report.
+
+    """
 
-def create_logger(logfilename):
-    """Create logger for logging to screen and file."""
+    prefix = "facescrub_"
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all metrics, e.g. at the start of a run"""
+
+        with self.lock:
+            self.counters = collections.Counter()  # (name, labels) -> value
+            self.gauges = collections.Counter()    # (name, labels) -> value
+            self.gauge_functions = {}              # name -> function returning the value
+            self.histograms = {}                   # (name, labels) -> [count per bucket, sum, count]
+            self.last_report = (time.monotonic(), 0, 0)  # (time, images, bytes) at last summary
+
+    def inc(self, name, value=1, **labels):
+        """Increase counter"""
+
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def add(self, name, value, **labels):
+        """Add value, which may be negative, to gauge"""
+
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] += value
+
+    def gauge(self, name, function):
+        """Read gauge from function whenever metrics are reported"""
+
+        with self.lock:
+            self.gauge_functions[name] = function
+
+    def observe(self, name, value, **labels):
+        """Add value to histogram"""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def total(self, name, **labels):
+        """Returns the sum of counter name over all label values matching labels"""
+
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items()
+                       if key == name and set(labels.items()) <= set(key_labels))
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join('{}="{}"'.format(key, escape(value)) for key, value in labels) + "}"
+
+    def prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+
+        gauge_values = [(name, function()) for name, function in list(self.gauge_functions.items())]
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted(set(key[0] for key in values)):
+                    lines.append("# TYPE {}{} {}".format(self.prefix, name, kind))
+                    for (key, labels), value in sorted(values.items()):
+                        if key == name:
+                            lines.append("{}{}{} {}".format(self.prefix, name, self.format_labels(labels), value))
+
+            for name, value in sorted(gauge_values):
+                lines.append("# TYPE {}{} gauge".format(self.prefix, name))
+                lines.append("{}{} {}".format(self.prefix, name, value))
+
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append("# TYPE {}{} histogram".format(self.prefix, name))
+                for (key, labels), (bucket_counts, total, count) in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    for bound, bucket_count in zip(self.buckets, bucket_counts):
+                        lines.append("{}{}_bucket{} {}".format(self.prefix, name, self.format_labels(labels, [("le", bound)]), bucket_count))
+                    lines.append("{}{}_bucket{} {}".format(self.prefix, name, self.format_labels(labels, [("le", "+Inf")]), count))
+                    lines.append("{}{}_sum{} {}".format(self.prefix, name, self.format_labels(labels), total))
+                    lines.append("{}{}_count{} {}".format(self.prefix, name, self.format_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Returns a one line progress report. Rates are since the previous summary."""
+
+        now = time.monotonic()
+        saved = self.total("images_total", result="saved")
+        failed = self.total("images_total", result="failed")
+        downloaded = self.total("bytes_total")
+        last_time, last_saved, last_downloaded = self.last_report
+        self.last_report = (now, saved, downloaded)
+        elapsed = max(now - last_time, 1e-6)
+
+        with self.lock:
+            in_flight = self.gauges[("in_flight", ())]
+            errors = collections.Counter()
+            for (name, labels), value in self.counters.items():
+                if name == "downloads_total" and dict(labels)["status"] != "ok":
+                    errors[dict(labels)["status"]] += value
+        gauges = dict((name, function()) for name, function in list(self.gauge_functions.items()))
+
+        line = "Progress: {} saved, {} failed, {:.1f} images/s, {:.2f} MB/s, {} in flight, {} queued, {} waiting to retry".format(
+            saved, failed, (saved - last_saved) / elapsed, (downloaded - last_downloaded) / elapsed / 1024 / 1024,
+            in_flight, gauges.get("queued_jobs", 0), gauges.get("delayed_jobs", 0))
+        requests_total = self.total("http_requests_total")
+        if requests_total:
+            line += ", {:.0%} of requests on reused connections".format(max(0, 1 - self.total("connections_total") / requests_total))
+        cache_hits = self.total("cache_hits_total")
+        if cache_hits:
+            line += ", {} from cache".format(cache_hits)
+        not_modified = self.total("not_modified_total")
+        if not_modified:
+            line += ", {} not modified".format(not_modified)
+        dead_links = self.total("dead_links_skipped_total")
+        if dead_links:
+            line += ", {} skipped as dead links".format(dead_links)
+        if errors:
+            line += ". Errors: " + ", ".join("{} {}".format(count, status) for status, count in errors.most_common(5))
+        return line
+
+
+metrics = Metrics()
+
+
+def record_download(counter, url, download, seconds):
+    """Update metrics after a download attempt, and log it as a structured record for the json log format"""
+
+    logger = logging.getLogger("logger")
+    logger.debug("Download {}".format(download.status),
+                 extra=line_fields(counter, url, event="download", status=download.status, error=download.error,
+                                   bytes=download.size, duration=round(seconds, 6)))
+
+    host = get_host(url)
+    metrics.inc("downloads_total", status=download.status)
+    if download.size:
+        metrics.inc("bytes_total", download.size)
+    metrics.observe("download_seconds", seconds)
+    metrics.inc("host_download_seconds_sum", seconds, host=host)
+    metrics.inc("host_download_seconds_count", host=host)
+
+
+def report_progress(stop, interval, metrics_file=None):
+    """Log a progress summary every interval seconds until stop (a threading.Event) is set.
+    Metrics are also written to metrics_file in Prometheus text format, if given.
+    """
+
+    logger = logging.getLogger("logger")
+    while True:
+        stopped = stop.wait(interval)
+        if metrics_file is not None:
+            # Write to a temporary file first so that readers never see a partial file
+            with open(metrics_file + ".tmp", 'w') as outfile:
+                outfile.write(metrics.prometheus())
+            os.replace(metrics_file + ".tmp", metrics_file)
+        if stopped:
+            return
+        logger.info(metrics.summary())
+
+
+def line_fields(counter, url=None, **fields):
+    """Returns extra for a logger call about a line of the data file.
+    The fields are written by the json log format.
+    """
+
+    fields["line"] = counter
+    if url is not None:
+        fields["url"] = url
+        fields["host"] = get_host(url)
+    return {"fields": fields}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, including fields from line_fields"""
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                 "level": record.levelname,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry)
+
+
+def is_text_record(record):
+    """Filter out structured records (e.g. one per download) that only the json log format writes"""
+
+    return "event" not in getattr(record, "fields", {})
+
+
+def create_logger(logfilename, log_format="text"):
+    """Create logger for logging to screen and file.
+
+    Records are put on a queue and written by a background thread, so logging
+    never blocks the download threads on file or console I/O. With log_format
+    "json", the log file has one JSON object per line with fields such as line,
+    url, host, status, error, bytes and duration. The console always gets text.
+
+    """
 
     logger = logging.getLogger("logger")
     logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(asctime)s\n%(message)s", "%Y-%m-%d %H:%M:%S")
+
+    # Called again, e.g. by a command that then downloads. Replace the previous handlers.
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if hasattr(handler, "listener"):
+            handler.listener.stop()
+            atexit.unregister(handler.listener.stop)
+            for listener_handler in handler.listener.handlers:
+                listener_handler.close()
+
     fh = logging.FileHandler(logfilename)
     fh.setLevel(logging.DEBUG)
-    formatter = logging.Formatter("%(asctime)s\n%(message)s", "%Y-%m-%d %H:%M:%S")
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    if log_format == "json":
+        fh.setFormatter(JsonFormatter())
+    else:
+        fh.setFormatter(formatter)
+        fh.addFilter(is_text_record)
 
     # Also print log messages to console
     console = logging.StreamHandler()
     console.setLevel(logging.DEBUG)
     console.setFormatter(formatter)
-    logger.addHandler(console)
+    console.addFilter(is_text_record)
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.listener = logging.handlers.QueueListener(log_queue, fh, console, respect_handler_level=True)
+    handler.listener.start()
+    logger.addHandler(handler)
+    atexit.register(handler.listener.stop)  # Write out remaining records
 
 
 def hashfile(afile, hasher=None, blocksize=65536):
@@ -140,6 +492,19 @@ def get_referer(url):
     return domain
 
 
+# Scheme and netloc at the start of a url
+URL_HOST_RE = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)")
+
+
+def get_host(url):
+    """Returns the host (netloc) of the given url"""
+
+    match = URL_HOST_RE.match(url)  # Much faster than urlparse, which matters for a whole data file
+    if match is not None:
+        return match.group(1)
+    return urllib.parse.urlparse(url).netloc
+
+
 def generate_headers(url):
     """Returns dict for header of requests"""
 
@@ -149,59 +514,393 @@ def generate_headers(url):
     return headers
 
 
-def download_image(counter, url, sha256, timeout):
-    """Download image from url.
-    Returns response object if successful else return None
+# Result of download_image. path is the temporary file if successful else None.
+# retry_after is the server's Retry-After in seconds, if any.
+# filetype is the extension of the image's format, found while downloading.
+# size is the number of bytes downloaded. error is the class name of the exception that made it fail.
+# validators are the Validators to download it conditionally next time, if any.
+# The image has been checked once path is set, so nothing after reads it to check it again.
+Download = collections.namedtuple("Download", ["path", "status", "retry_after", "filetype", "size", "error", "validators"],
+                                  defaults=(None, None, None, None))
+
+# What is known about a url from downloading it before (see HttpCache).
+# etag and last_modified are the server's ETag and Last-Modified headers, if any.
+# final_url is the url it redirected to, or None if it did not redirect.
+# image_path is the saved copy of the image, whose hash was sha256, or None if it was not saved as a file.
+Validators = collections.namedtuple("Validators", ["etag", "last_modified", "final_url", "sha256", "image_path"])
+
+
+# First bytes of common image formats and their extension
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"MM\x00*", "tiff"),
+    (b"II*\x00", "tiff"),
+    (b"BM", "bmp"),
+]
+
+
+def guess_filetype(header):
+    """Returns the file extension of an image given its first bytes, or None if it is not an image
+
+    Common formats are recognized by their signature. Others are left to
+    libmagic if it is installed.
+
+    """
+
+    for signature, filetype in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return filetype
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+
+    if not has_magic_lib:
+        return None
+    mimetype = magic.from_buffer(header, mime=True)
+    if mimetype is None or not mimetype.startswith("image/"):
+        return None
+    ext = mimetypes.guess_extension(mimetype)
+    if ext is None:
+        return None
+    filetype = ext.lstrip('.')
+    if filetype in ("jpe", "jpg"):
+        filetype = "jpeg"
+    return filetype
+
+
+class InvalidImage(Exception):
+    """Raised when downloaded content is not the expected image
+
+    status is recorded in the manifest, e.g. "hash_mismatch"
+
+    """
+
+    def __init__(self, message, status):
+        super(InvalidImage, self).__init__(message)
+        self.status = status
+
+
+class ImageStream(object):
+    """Write a downloaded image to a temporary file chunk by chunk
+
+    The sha256 hash is updated as chunks arrive and the file type is found
+    from the first bytes only, so the image is never held in memory as a whole
+    and each byte is looked at once. Raises InvalidImage as soon as the
+    content is known to be bad, so the caller can stop downloading.
+
+    """
+
+    chunk_size = 65536
+    sniff_size = 2048  # Enough bytes for magic to recognize image formats
+
+    def __init__(self, headers, sha256, tmpdir, max_size):
+        content_length = headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_size:
+            raise InvalidImage("Image too large ({} bytes)".format(content_length), "too_large")
+
+        self.sha256 = sha256
+        self.max_size = max_size
+        self.size = 0
+        self.header = b""       # First bytes of the image
+        self.filetype = None    # Extension of the image's format, once known
+        self.hasher = hashlib.sha256()
+        fd, self.path = tempfile.mkstemp(dir=tmpdir)
+        self.file = os.fdopen(fd, 'wb')
+
+    def check_type(self):
+        """Check that the content is an image and find its file type"""
+
+        self.filetype = guess_filetype(self.header)
+        if self.filetype is None:
+            raise InvalidImage("Not an image of a known type", "invalid_type")
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise InvalidImage("Image too large (more than {} bytes)".format(self.max_size), "too_large")
+
+        if self.filetype is None:
+            self.header = (self.header + chunk)[:self.sniff_size]
+            if len(self.header) >= self.sniff_size:
+                self.check_type()
+
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+
+    def close(self):
+        """Finish writing. Returns path to the temporary file if the image is valid."""
+
+        self.file.close()
+        if self.filetype is None:  # Image smaller than sniff_size
+            self.check_type()
+
+        if self.hasher.hexdigest() != self.sha256:
+            raise InvalidImage("SHA 256 hash different", "hash_mismatch")
+
+        return self.path
+
+    def discard(self):
+        """Remove the temporary file"""
+
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def remaining_timeout(timeout, deadline):
+    """Returns the (connect, read) timeout, shortened so that neither goes past deadline (time.monotonic())"""
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise Timeout("Download took longer than its deadline")
+    connect_timeout, read_timeout = timeout
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def iter_body(response, deadline):
+    """Yields chunks of a streamed response's body as they arrive. Raises Timeout once deadline (time.monotonic()) passes."""
+
+    raw = response.raw
+    if hasattr(raw, "read1"):  # urllib3 >= 2 returns what has arrived instead of waiting for a full chunk
+        # Undo Content-Encoding such as gzip, as iter_content does
+        def read():
+            try:
+                return raw.read1(ImageStream.chunk_size, decode_content=True)
+            except urllib3.exceptions.ReadTimeoutError as e:
+                raise Timeout(e)
+            except (urllib3.exceptions.ProtocolError, urllib3.exceptions.DecodeError) as e:
+                raise RequestException(e)
+        chunks = iter(read, b"")
+    else:
+        chunks = response.iter_content(chunk_size=ImageStream.chunk_size)
+
+    for chunk in chunks:
+        if time.monotonic() > deadline:  # Server sends too slowly, but never slow enough for the read timeout
+            raise Timeout("Download took longer than its deadline")
+        yield chunk
+
+
+def conditional_headers(validators, sha256):
+    """Returns headers that make the server only send the image if it changed since validators were recorded.
+    Empty if there is no saved copy of the image with hash sha256 to use instead.
+    """
+
+    if validators is None or validators.sha256 != sha256 or validators.image_path is None:
+        return {}
+    if not os.path.isfile(validators.image_path):  # Removed, or saved to a shard
+        return {}
+    headers = {}
+    if validators.etag:
+        headers["If-None-Match"] = validators.etag
+    if validators.last_modified:
+        headers["If-Modified-Since"] = validators.last_modified
+    return headers
+
+
+def copy_not_modified(validators, tmpdir, max_size):
+    """Copy the saved copy of an image the server says has not changed to a temporary file in tmpdir.
+    It goes through the same checks as a download, so a copy changed since it was saved raises InvalidImage.
+    Returns the closed ImageStream
+    """
+
+    stream = ImageStream({}, validators.sha256, tmpdir, max_size)
+    try:
+        with open(validators.image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ImageStream.chunk_size), b""):
+                stream.write(chunk)
+        stream.close()
+    except (InvalidImage, OSError) as e:
+        stream.discard()
+        raise InvalidImage("Saved copy is not the image: {}".format(e), "hash_mismatch")
+    return stream
+
+
+def open_url(url, headers, timeout, deadline):
+    """GET url, following redirects here so that every hop counts against deadline (time.monotonic()).
+    Returns the streamed response, which the caller closes
+    """
+
+    metrics.inc("http_requests_total")
+    response = session.get(url, headers=headers, timeout=remaining_timeout(timeout, deadline), stream=True,
+                           allow_redirects=False)
+    for _ in range(session.max_redirects):
+        if not response.is_redirect:
+            return response
+        next_request = response.next
+        response.content  # Read the body, as requests does, so that the connection is reused rather than closed
+        response.close()
+        metrics.inc("http_requests_total")
+        response = session.send(next_request, timeout=remaining_timeout(timeout, deadline), stream=True,
+                                allow_redirects=False)
+    response.close()
+    raise TooManyRedirects("Exceeded {} redirects".format(session.max_redirects), response=response)
+
+
+def download_image(counter, url, sha256, timeout, tmpdir, max_size, deadline=None, validators=None):
+    """Download image from url to a temporary file in tmpdir.
+    timeout is (connect timeout, read timeout) in seconds. The read timeout applies to each read.
+    deadline is the most seconds the whole download may take, including redirects, or None for no limit.
+    validators are the Validators of url from an earlier run, if any. The request then goes straight to the
+    url it redirected to, and if the image was saved, the saved copy is used if the server says it has not changed.
+    Returns a Download
     """
 
     logger = logging.getLogger("logger")
+    stream = None
+    response = None
     try:
         headers = generate_headers(url)
-        response = session.get(url, headers=headers, timeout=timeout)
+        deadline = time.monotonic() + deadline if deadline is not None else float("inf")
+        conditional = conditional_headers(validators, sha256)
+        request_url = validators.final_url if validators is not None and validators.final_url else url
+
+        response = open_url(request_url, dict(headers, **conditional), timeout, deadline)
+        if response.status_code >= 400 and request_url != url:  # Moved again. Start over from url.
+            response.close()
+            response = open_url(url, dict(headers, **conditional), timeout, deadline)
+
+        if response.status_code == 304 and conditional:  # Not Modified
+            response.content  # No body, but reading it lets the connection be reused
+            try:
+                stream = copy_not_modified(validators, tmpdir, max_size)
+                metrics.inc("not_modified_total")
+                new_validators = Validators(response.headers.get("etag", validators.etag),
+                                            response.headers.get("last-modified", validators.last_modified),
+                                            response.url if response.url != url else None, sha256, None)
+                filetype, path, stream = stream.filetype, stream.path, None
+                return Download(path, "ok", None, filetype, 0, validators=new_validators)
+            except InvalidImage as e:  # Download it again
+                logger.info("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+                response.close()
+                response = open_url(url, headers, timeout, deadline)
 
         if response.status_code != requests.codes.OK:  # Status 200
             response.raise_for_status()
 
-        # Check if returned image
-        if has_magic_lib:
-            # This returns byte string
-            content_type = magic.from_buffer(response.content, mime=True)
-        else:
-            content_type = response.headers["content-type"]  # Sometimes this is missing, raising KeyError
+        stream = ImageStream(response.headers, sha256, tmpdir, max_size)
+        for chunk in iter_body(response, deadline):
+            stream.write(chunk)
+        path = stream.close()
 
-        if (content_type is None) or not content_type.startswith("image"):
-            logger.error("Line {number}: Invalid content-type {content_type}: {url}".format(number=counter,
-                                                                                            content_type=content_type,
-                                                                                            url=url))
-            return None
-
-        if hashbinary(response.content) != sha256:
-            logger.error("Line {number}: SHA 256 hash different: {url}".format(number=counter, url=url))
-            return None
-
-        return response
+        new_validators = Validators(response.headers.get("etag"), response.headers.get("last-modified"),
+                                    response.url if response.url != url else None, sha256, None)
+        filetype, size, stream = stream.filetype, stream.size, None
+        return Download(path, "ok", None, filetype, size, validators=new_validators)
 
+    except InvalidImage as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, e.status, None, error=type(e).__name__)
     except KeyError as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "invalid_type", None, error=type(e).__name__)
     except ConnectionError as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "connection_error", None, error=type(e).__name__)
     except HTTPError as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "http_{}".format(e.response.status_code), parse_retry_after(e.response.headers.get("retry-after")), error=type(e).__name__)
     except Timeout as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "timeout", None, error=type(e).__name__)
     except TooManyRedirects as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "too_many_redirects", None, error=type(e).__name__)
     except RequestException as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "error", None, error=type(e).__name__)
     except Exception as e:
-        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-        return None
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "error", None, error=type(e).__name__)
+    finally:
+        if response is not None:
+            response.close()
+        if stream is not None:
+            stream.discard()
+
+
+async def download_image_async(client, counter, url, sha256, timeout, tmpdir, max_size, max_retries=1, deadline=None, validators=None):
+    """Download image from url to a temporary file in tmpdir using an aiohttp client session.
+    timeout, deadline and validators are as for download_image. Same checks as download_image. Returns a Download
+    """
+
+    logger = logging.getLogger("logger")
+    stream = None
+    try:
+        headers = generate_headers(url)
+        # total covers connecting, redirects and reading the whole body
+        client_timeout = aiohttp.ClientTimeout(total=deadline, sock_connect=timeout[0], sock_read=timeout[1])
+        conditional = conditional_headers(validators, sha256)
+        request_url = validators.final_url if validators is not None and validators.final_url else url
+
+        async def fetch(request_url, extra_headers):
+            """Download request_url into stream unless it was not modified. Returns (not modified, the response's Validators)"""
+
+            nonlocal stream
+            # Mirror HTTPAdapter(max_retries) which only retries failed connections
+            for attempt in range(max_retries + 1):
+                try:
+                    async with client.get(request_url, headers=dict(headers, **extra_headers), timeout=client_timeout) as response:
+                        final_url = str(response.url)
+                        if response.status == 304 and extra_headers:
+                            return True, Validators(response.headers.get("etag", validators.etag),
+                                                    response.headers.get("last-modified", validators.last_modified),
+                                                    final_url if final_url != url else None, sha256, None)
+                        response.raise_for_status()
+                        stream = ImageStream(response.headers, sha256, tmpdir, max_size)
+                        async for chunk in response.content.iter_chunked(ImageStream.chunk_size):
+                            stream.write(chunk)
+                        stream.close()
+                        return False, Validators(response.headers.get("etag"), response.headers.get("last-modified"),
+                                                 final_url if final_url != url else None, sha256, None)
+                except aiohttp.ClientConnectorError:
+                    if attempt == max_retries:
+                        raise
+
+        try:
+            not_modified, new_validators = await fetch(request_url, conditional)
+        except aiohttp.ClientResponseError:
+            if request_url == url:
+                raise
+            not_modified, new_validators = await fetch(url, conditional)  # Moved again. Start over from url.
+
+        if not_modified:
+            loop = asyncio.get_running_loop()
+            try:
+                stream = await loop.run_in_executor(None, copy_not_modified, validators, tmpdir, max_size)
+                metrics.inc("not_modified_total")
+                filetype, path, stream = stream.filetype, stream.path, None
+                return Download(path, "ok", None, filetype, 0, validators=new_validators)
+            except InvalidImage as e:  # Download it again
+                logger.info("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+                not_modified, new_validators = await fetch(url, {})
+
+        filetype, size, path, stream = stream.filetype, stream.size, stream.path, None
+        return Download(path, "ok", None, filetype, size, validators=new_validators)
+
+    except InvalidImage as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, e.status, None, error=type(e).__name__)
+    except KeyError as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        return Download(None, "invalid_type", None, error=type(e).__name__)
+    except aiohttp.ClientResponseError as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+        retry_after = parse_retry_after(e.headers.get("retry-after")) if e.headers is not None else None
+        return Download(None, "http_{}".format(e.status), retry_after, error=type(e).__name__)
+    except aiohttp.ClientConnectionError as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=str(e) or type(e).__name__, url=url), extra=line_fields(counter, url))
+        return Download(None, "connection_error", None, error=type(e).__name__)
+    except asyncio.TimeoutError as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=str(e) or "Timed out", url=url), extra=line_fields(counter, url))
+        return Download(None, "timeout", None, error=type(e).__name__)
+    except Exception as e:
+        logger.error("Line {number}: {error}: {url}".format(number=counter, error=str(e) or type(e).__name__, url=url), extra=line_fields(counter, url))
+        return Download(None, "error", None, error=type(e).__name__)
+    finally:
+        if stream is not None:
+            stream.discard()
 
 
 def parse_line(line):
@@ -221,85 +920,2100 @@ def parse_line(line):
 
 def ensure_dir_exists(dirpath):
     """Create directory specified by dirpath if it does not exists"""
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
+    os.makedirs(dirpath, exist_ok=True)  # Other threads may create it at the same time
+
+
+class DataFile(object):
+    """A FaceScrub data file loaded into columns, with indexes to select faces quickly
+
+    Every column has one entry per face: its line number, name, image_id,
+    face_id, url, bbox, sha256 and host. Numbers are kept in arrays and
+    repeated strings are shared, so the whole file takes little memory.
+    by_name, by_image_id, by_sha256 and by_host map a value to the rows
+    (positions in the columns) that have it, in file order.
+
+    lines is an iterable of (counter, line). Lines that cannot be parsed are
+    logged and left out.
+
+    """
+
+    __slots__ = ("lines", "names", "image_ids", "face_ids", "urls", "bboxes", "sha256s", "hosts",
+                 "by_name", "by_image_id", "by_sha256", "by_host")
+
+    def __init__(self, lines):
+        logger = logging.getLogger("logger")
+        self.lines = array.array('l')
+        self.names = []
+        self.image_ids = array.array('l')
+        self.face_ids = array.array('l')
+        self.urls = []
+        self.bboxes = array.array('l')  # 4 numbers per face
+        self.sha256s = []
+        self.hosts = []
+        self.by_name = collections.defaultdict(list)
+        self.by_image_id = collections.defaultdict(list)
+        self.by_sha256 = collections.defaultdict(list)
+        self.by_host = collections.defaultdict(list)
+
+        for counter, line in lines:
+            try:
+                name, image_id, face_id, url, bbox, sha256 = parse_line(line)
+                if len(bbox) != 4:
+                    raise ValueError("bbox must have 4 numbers")
+            except (IndexError, ValueError) as e:
+                logger.error("Line {number}: Cannot parse line: {error}".format(number=counter, error=e), extra=line_fields(counter))
+                continue
+
+            row = len(self.lines)
+            name, host = sys.intern(name), sys.intern(get_host(url))
+            self.lines.append(counter)
+            self.names.append(name)
+            self.image_ids.append(image_id)
+            self.face_ids.append(face_id)
+            self.urls.append(url)
+            self.bboxes.extend(bbox)
+            self.sha256s.append(sha256)
+            self.hosts.append(host)
+            self.by_name[name].append(row)
+            self.by_image_id[image_id].append(row)
+            self.by_sha256[sha256].append(row)
+            self.by_host[host].append(row)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def face(self, row):
+        """Returns (counter, name, image_id, face_id, bbox) of row, with spaces in name replaced by underscores"""
+
+        return (self.lines[row], self.names[row].replace(' ', '_'), self.image_ids[row], self.face_ids[row],
+                list(self.bboxes[4 * row:4 * row + 4]))
+
+    def select(self, names=None, hosts=None, sample=None, seed=None):
+        """Returns the rows of the faces of the given names (as in the data file) and hosts, in file order.
+        If sample is given, at most that many rows picked at random with seed are returned.
+        """
+
+        if names is None and hosts is None:
+            rows = range(len(self))
+        else:
+            rows = None
+            if names is not None:
+                rows = set(row for name in names for row in self.by_name.get(name, ()))
+            if hosts is not None:
+                host_rows = set(row for host in hosts for row in self.by_host.get(host, ()))
+                rows = host_rows if rows is None else rows & host_rows
+            rows = sorted(rows)
+
+        if sample is not None and sample < len(rows):
+            rows = sorted(random.Random(seed).sample(rows, sample))
+        return list(rows)
+
+    def plan(self, rows, order="file", seed=None):
+        """Group rows that point to the same image into download jobs
+
+        Yields (url, sha256, faces), where faces is a list of (counter, name,
+        image_id, face_id, bbox). order is "file" to keep the order of the
+        data file, "shuffle" for a random order from seed, or "hosts" to take
+        one image from each host in turn, so that the HostScheduler has many
+        hosts to choose from even when the data file lists images of one site
+        together.
+
+        Jobs are built from the columns as they are taken, so only those the
+        scheduler holds take memory. Other orders keep one row number per image.
+
+        """
+
+        selected = rows if isinstance(rows, range) else set(rows)
+
+        def group(row):
+            """Selected rows with the url and sha256 of row, in file order"""
+            url = self.urls[row]
+            return [other for other in self.by_sha256[self.sha256s[row]] if self.urls[other] == url and other in selected]
+
+        # First row of each image
+        firsts = (row for row in rows if group(row)[0] == row)
+        if order == "shuffle":
+            firsts = array.array('l', firsts)
+            random.Random(seed).shuffle(firsts)
+        elif order == "hosts":
+            by_host = collections.defaultdict(lambda: array.array('l'))  # In the order hosts are first seen
+            for row in firsts:
+                by_host[self.hosts[row]].append(row)
+            firsts = round_robin(by_host.values())
+
+        for row in firsts:
+            yield self.urls[row], self.sha256s[row], [self.face(other) for other in group(row)]
+
+
+def round_robin(sequences):
+    """Yields the first item of each sequence, then the second of each, and so on, skipping sequences that ran out"""
+
+    iterators = [iter(sequence) for sequence in sequences]
+    while iterators:
+        remaining = []
+        for iterator in iterators:
+            for item in iterator:
+                yield item
+                remaining.append(iterator)
+                break
+        iterators = remaining
+
+
+# Failures that may succeed if tried again later
+TRANSIENT_STATUSES = frozenset(["timeout", "connection_error",
+                                "http_408", "http_429", "http_500", "http_502", "http_503", "http_504"])
+
+
+def parse_retry_after(value):
+    """Returns the number of seconds to wait given a Retry-After header, or None if it cannot be parsed"""
+
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# Host under which HostScheduler queues jobs that need no request
+LOCAL_HOST = None
+
+
+class HostScheduler(object):
+    """Hand out download jobs round-robin across hosts.
+
+    At most max_per_host downloads run at the same time for each host, and a
+    host is sent at most rate_per_host new requests per second (0 for no limit).
+    Hosts that are busy or rate limited are skipped, so workers move on to other
+    hosts instead of waiting.
+
+    Jobs are added by a producer with add and close. At most max_pending jobs
+    wait in the scheduler; add blocks when it is full.
 
+    Jobs that fail with a status in TRANSIENT_STATUSES are put back after a
+    jittered exponential backoff, or after the server's Retry-After, up to
+    retry_attempts times. No worker sleeps while a job waits to be retried.
 
-def save_image(counter, url, response, datasetpath, name, image_id, face_id, bbox, save_face=False):
-    """Save image
+    local is an optional function of a job's url and sha256 that returns True
+    if the job needs no request to its host, e.g. the image is in a BlobCache
+    or the host is known to be down. Such jobs are queued apart, or handed out
+    ahead of the limits of their host if they became local while queued.
+
+    on_change, if set, is called with the lock held whenever a job may have
+    become ready to start, so that workers that do not wait on condition, e.g.
+    those of an event loop, can be woken instead of polling. It must not block.
+
+    """
+
+    # Seconds to wait before checking again when all remaining hosts are busy
+    poll_interval = 0.1
+
+    # Backoff before retry n is about backoff_base * 2 ** n seconds, at most max_backoff
+    backoff_base = 2.0
+    max_backoff = 600.0
+
+    def __init__(self, max_per_host=2, rate_per_host=0, max_pending=10000, retry_attempts=3, local=None):
+        self.max_per_host = max_per_host
+        self.min_interval = 1.0 / rate_per_host if rate_per_host > 0 else 0
+        self.max_pending = max_pending
+        self.retry_attempts = retry_attempts
+        self.local = local
+        self.condition = threading.Condition()
+        self.queues = collections.OrderedDict()  # host -> jobs not yet started
+        self.pending = {}                        # (url, sha256) -> job not yet started
+        self.active = collections.Counter()      # host -> number of running jobs
+        self.running = collections.defaultdict(list)  # (url, sha256) -> hosts the running jobs were queued under
+        self.next_start = {}                     # host -> earliest time of next request
+        self.delayed = []                        # heap of (retry time, sequence number, job)
+        self.attempts = collections.Counter()    # (url, sha256) -> number of failed attempts
+        self.sequence = 0
+        self.closed = False
+        self.on_change = None
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _enqueue(self, job):
+        url, sha256, faces = job
+        key = (url, sha256)
+        if key in self.pending:  # Same image is still waiting. Download it once for all faces.
+            self.pending[key][2].extend(faces)
+            return
+
+        host = LOCAL_HOST if self.local is not None and self.local(url, sha256) else get_host(url)
+        if host not in self.queues:
+            self.queues[host] = collections.deque()
+            self._changed()  # Jobs queued behind others of their host are not ready any sooner
+        self.queues[host].append(job)
+        self.pending[key] = job
+
+    def add(self, job):
+        """Queue a job (url, sha256, faces). Blocks while max_pending jobs are waiting."""
+
+        with self.condition:
+            while (job[0], job[1]) not in self.pending and len(self.pending) >= self.max_pending:
+                self.condition.wait()
+            self._enqueue(job)
+
+    def close(self):
+        """No more jobs will be added"""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            self._changed()
+
+    def feed(self, jobs):
+        """Add all jobs then close. Meant to run in its own thread."""
+
+        try:
+            for job in jobs:
+                self.add(job)
+        finally:
+            self.close()
+
+    def next_job(self):
+        """Returns (job, wait) without blocking.
+
+        job is the next job to start, or None if no host can be contacted now.
+        In that case wait is the number of seconds to wait before asking again,
+        or None if there are no jobs left.
+
+        """
+
+        with self.condition:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                self._enqueue(heapq.heappop(self.delayed)[2])
+
+            wait = self.poll_interval
+            if self.delayed:
+                wait = min(wait, self.delayed[0][0] - now)
+
+            if not self.queues:
+                if self.closed and not self.delayed and not self.active:
+                    return None, None
+                return None, wait
+
+            for host in self.queues:
+                jobs = self.queues[host]
+                local = host is LOCAL_HOST
+                if not local and (self.active[host] >= self.max_per_host or self.next_start.get(host, 0) > now):
+                    local = self.local is not None and self.local(jobs[0][0], jobs[0][1])
+                    if not local:
+                        if self.active[host] < self.max_per_host:
+                            wait = min(wait, self.next_start[host] - now)
+                        continue
+
+                job = jobs.popleft()
+                if jobs:
+                    self.queues.move_to_end(host)  # Give the other hosts a turn first
+                else:
+                    del self.queues[host]
+                del self.pending[(job[0], job[1])]
+                self.active[host] += 1
+                self.running[(job[0], job[1])].append(host)
+                if not local:
+                    self.next_start[host] = now + self.min_interval
+                self.condition.notify_all()  # Room for the producer
+                return job, None
+
+            return None, wait
+
+    def wait_job(self):
+        """Blocks until a job can be started. Returns None if there are no jobs left."""
+
+        with self.condition:
+            while True:
+                job, wait = self.next_job()
+                if job is not None or wait is None:
+                    return job
+                self.condition.wait(wait)
+
+    def done(self, job, status="ok", retry_after=None):
+        """Mark job as finished so that its host can be contacted again.
+
+        If status is transient and the job has retries left, it is scheduled to
+        run again. Returns the delay in seconds before the retry, or None if
+        the job will not be retried.
+
+        """
+
+        url, sha256, faces = job
+        key = (url, sha256)
+        with self.condition:
+            host = self.running[key].pop()
+            if not self.running[key]:
+                del self.running[key]
+            self.active[host] -= 1
+            if self.active[host] <= 0:
+                del self.active[host]
+            self.condition.notify_all()
+            self._changed()
+
+            if status not in TRANSIENT_STATUSES or self.attempts[key] >= self.retry_attempts:
+                self.attempts.pop(key, None)
+                return None
+
+            self.attempts[key] += 1
+            delay = self.backoff_base * 2 ** (self.attempts[key] - 1) * random.uniform(0.5, 1.5)
+            if retry_after is not None:
+                delay = retry_after
+            delay = min(delay, self.max_backoff)
+
+            # Server asked to slow down, so hold back the whole host
+            now = time.monotonic()
+            if retry_after is not None and host is not LOCAL_HOST:
+                self.next_start[host] = max(self.next_start.get(host, 0), now + delay)
+
+            self.sequence += 1
+            heapq.heappush(self.delayed, (now + delay, self.sequence, job))
+            return delay
+
+
+# How faces are cropped. padding is the fraction of the bbox's width and height
+# added on each side. size is (width, height) to resize faces to, or None to
+# keep them as cropped; the box is first widened or heightened to the same
+# aspect ratio and moved inside the image, so faces are not stretched. format
+# is the extension to save faces as, or None for that of the image. quality is
+# for JPEG and WebP. Without padding or size, the bbox is cropped as given.
+CropOptions = collections.namedtuple("CropOptions", ["padding", "size", "format", "quality"], defaults=(0, None, None, None))
+
+
+def crop_box(bbox, image_size, options):
+    """Returns the box to crop for bbox in an image of image_size with CropOptions options"""
+
+    if not options.padding and options.size is None:
+        # The bbox as given. Parts of it outside the image come out black.
+        return tuple(bbox)
+
+    x1, y1, x2, y2 = bbox
+    pad_x, pad_y = (x2 - x1) * options.padding, (y2 - y1) * options.padding
+    x1, y1, x2, y2 = x1 - pad_x, y1 - pad_y, x2 + pad_x, y2 + pad_y
+
+    if options.size is not None:
+        width, height = x2 - x1, y2 - y1
+        aspect = options.size[0] / options.size[1]
+        if width < height * aspect:
+            x1, x2 = x1 - (height * aspect - width) / 2, x2 + (height * aspect - width) / 2
+        else:
+            y1, y2 = y1 - (width / aspect - height) / 2, y2 + (width / aspect - height) / 2
+
+        # Keep the aspect ratio so the face is not stretched: shrink a box larger
+        # than the image about its center, then move it inside the image
+        width, height = x2 - x1, y2 - y1
+        scale = min(1, image_size[0] / width, image_size[1] / height)
+        x1, y1 = x1 + width * (1 - scale) / 2, y1 + height * (1 - scale) / 2
+        width, height = width * scale, height * scale
+        x1 = min(max(x1, 0), image_size[0] - width)
+        y1 = min(max(y1, 0), image_size[1] - height)
+        x2, y2 = x1 + width, y1 + height
+
+    # Padding may go past the edges of the image
+    return (max(0, int(round(x1))), max(0, int(round(y1))),
+            min(image_size[0], int(round(x2))), min(image_size[1], int(round(y2))))
+
+
+# Encoder settings for faces. Faces are small and many, so favour speed over
+# the last few percent of file size: PNG and WebP compress in a fraction of
+# the time of their defaults. Pillow's JPEG defaults are already fast.
+FACE_SAVE_PARAMS = {
+    "PNG": {"compress_level": 1},
+    "WEBP": {"method": 2},
+}
+
+
+def save_face_image(face, buf, ext, options):
+    """Resize the cropped face image as in CropOptions options and save it to buf, a path or file object"""
+
+    if options.size is not None and face.size != tuple(options.size):
+        # reducing_gap first shrinks by a whole factor, which is much faster for large faces and looks the same
+        face = face.resize(tuple(options.size), Image.LANCZOS, reducing_gap=3.0)
+
+    image_format = Image.registered_extensions().get('.' + ext, ext.upper())
+    params = dict(FACE_SAVE_PARAMS.get(image_format, {}))
+    if image_format in ("JPEG", "WEBP"):
+        if face.mode not in ("RGB", "L"):
+            face = face.convert("RGB")
+        if options.quality is not None:
+            params["quality"] = options.quality
+    face.save(buf, format=image_format, **params)
+
+
+def load_faces(image_path, faces, options):
+    """Decode the image at image_path once for all its faces
+
+    Returns (image, boxes), where boxes are the boxes to crop for faces in
+    image, as given by crop_box. Raises IOError if the image cannot be read.
+
+    """
+
+    I = Image.open(image_path)
+    boxes = [crop_box(bbox, I.size, options) for _, _, _, _, bbox in faces]
+
+    # Faces are resized to options.size anyway, so a JPEG can be decoded at
+    # 1/2, 1/4 or 1/8 scale as long as every face stays at least that size.
+    # This is much faster and uses less memory for large photos.
+    if options.size is not None and I.format == "JPEG":
+        needed = max(max(options.size[0] / max(1, x2 - x1), options.size[1] / max(1, y2 - y1)) for x1, y1, x2, y2 in boxes)
+        if needed < 1:
+            width, height = I.size
+            I.draft(I.mode, (int(math.ceil(width * needed)), int(math.ceil(height * needed))))
+            scale = min(I.size[0] / width, I.size[1] / height)
+            boxes = [(int(x1 * scale), int(y1 * scale), min(I.size[0], int(math.ceil(x2 * scale))), min(I.size[1], int(math.ceil(y2 * scale))))
+                     for x1, y1, x2, y2 in boxes]
+
+    I.load()
+    return I, boxes
+
+
+def crop_faces(image_path, faces, datasetpath, filetype, options=None):
+    """Crop faces from the image at image_path
+
+    Face images saved to datasetpath/faces/name_image_id_face_id.ext, where ext
+    is options.format if given, else filetype. options is a CropOptions.
+    If datasetpath is None, faces are encoded in memory instead of saved.
+    This runs in a worker process of the crop pool, so errors are returned instead of logged.
+
+    Returns (face_paths, errors). face_paths maps face_id to the path of the
+    saved face, or to the encoded face as bytes if datasetpath is None.
+    errors is a list of (counter, error message).
+
+    """
+
+    options = options or CropOptions()
+    ext = options.format or filetype
+    face_paths = {}
+    errors = []
+    try:
+        I, boxes = load_faces(image_path, faces, options)  # Decode once for all faces in this image
+    except IOError as e:
+        return face_paths, [(faces[0][0], str(e))]
+
+    for (face_counter, face_name, face_image_id, face_id, bbox), box in zip(faces, boxes):
+        try:
+            face = I.crop(box)
+            if datasetpath is None:
+                buf = io.BytesIO()
+                save_face_image(face, buf, ext, options)
+                face_paths[face_id] = buf.getvalue()
+                continue
+
+            output_dir = os.path.join(datasetpath, "faces", face_name)
+            ensure_dir_exists(output_dir)
+            filename = "{name}_{image_id}_{face_id}.{ext}".format(name=face_name,
+                                                                  image_id=face_image_id,
+                                                                  face_id=face_id,
+                                                                  ext=ext)
+            save_face_image(face, os.path.join(output_dir, filename), ext, options)
+            face_paths[face_id] = os.path.join(output_dir, filename)
+        except (IOError, ValueError) as e:
+            errors.append((face_counter, str(e)))
+
+    return face_paths, errors
+
+
+def save_image(counter, url, path, filetype, datasetpath, faces, save_face=False, crop_pool=None, shard_writer=None,
+               crop_options=None, on_saved=None):
+    """Save image downloaded to the temporary file at path
+
+    filetype is the extension of the image's format, as found by ImageStream.
+    faces is a list of (counter, name, image_id, face_id, bbox) that share this image.
+    Faces are cropped as in crop_options, a CropOptions, in crop_pool, a CropQueue, if given.
 
     Full images saved to datasetpath/images/name_image_id.ext
     Face images saved to datasetpath/faces/name_image_id_face_id.ext
+    If shard_writer is given, images and faces are appended to its shards instead.
 
-    Returns True if successful else False
+    Returns a list of (face, image_path, face_path) if successful else an empty list.
+    face_path is None if the face was not cropped. If faces are cropped in
+    crop_pool, returns None at once and calls on_saved with the list once they are.
 
     """
 
     logger = logging.getLogger("logger")
+    _, name, image_id, _, _ = faces[0]
+
+    if shard_writer is not None:
+        return save_image_to_shard(counter, url, path, filetype, faces, shard_writer, save_face, crop_pool, crop_options, on_saved)
 
     # Output dir for images is datasetpath/images/name
     output_dir = os.path.join(datasetpath, "images", name)
     ensure_dir_exists(output_dir)
 
-    # Filename without extension
-    filename = "{name}_{image_id}".format(name=name,
-                                          image_id=image_id)
-    outpath = os.path.join(output_dir, filename)
+    # Move the temporary file straight to its final name. Both are on the same
+    # filesystem, so this is an atomic rename.
+    filename = "{name}_{image_id}.{ext}".format(name=name,
+                                                image_id=image_id,
+                                                ext=filetype)
+    newpath = os.path.join(output_dir, filename)
+    os.replace(path, newpath)
+
+    # Same image listed under another name or image_id. Link (or copy) instead of downloading again.
+    image_paths = {(name, image_id): newpath}
+    for _, other_name, other_image_id, _, _ in faces:
+        if (other_name, other_image_id) in image_paths:
+            continue
+        other_dir = os.path.join(datasetpath, "images", other_name)
+        ensure_dir_exists(other_dir)
+        other_filename = "{name}_{image_id}.{ext}".format(name=other_name,
+                                                          image_id=other_image_id,
+                                                          ext=filetype)
+        other_path = image_paths[(other_name, other_image_id)] = os.path.join(other_dir, other_filename)
+        if os.path.exists(other_path):  # Saved by an earlier run. Link to the new file rather than copy over it.
+            os.remove(other_path)
+        link_or_copy(newpath, other_path)
+
+    def cropped(face_paths, errors):
+        for face_counter, error in errors:
+            logger.error("Line {number}: {error}: {url}".format(number=face_counter, error=error, url=url), extra=line_fields(face_counter, url))
+        return [(face, image_paths[(face[1], face[2])], face_paths.get(face[3])) for face in faces]
+
+    # If user wants face images
+    if not save_face:
+        return cropped({}, [])
+    if crop_pool is not None:
+        crop_pool.submit(lambda face_paths, errors: on_saved(cropped(face_paths, errors)),
+                         newpath, faces, datasetpath, filetype, crop_options)
+        return None
+    return cropped(*crop_faces(newpath, faces, datasetpath, filetype, crop_options))
+
+
+def save_image_to_shard(counter, url, path, filetype, faces, shard_writer, save_face=False, crop_pool=None, crop_options=None,
+                        on_saved=None):
+    """Append image downloaded to the temporary file at path, and its faces, to a shard
+
+    Returns a list of (face, image_path, face_path) like save_image, where the
+    paths are of the form shards/shard-NNNNNN.tar:member. Like save_image, if
+    faces are cropped in crop_pool, returns None and calls on_saved with the list later.
+
+    """
+
+    logger = logging.getLogger("logger")
 
-    # Save file without file extension
-    with open(outpath, 'wb') as outfile:
-        outfile.write(response.content)
+    def cropped(face_data, errors):
+        for face_counter, error in errors:
+            logger.error("Line {number}: {error}: {url}".format(number=face_counter, error=error, url=url), extra=line_fields(face_counter, url))
 
-    filetype = imghdr.what(outpath)
+        # The image is stored once and indexed under every name and image_id it is listed under
+        _, name, image_id, _, _ = faces[0]
+        image_keys = []
+        for _, face_name, face_image_id, _, _ in faces:
+            if (face_name, face_image_id, -1) not in image_keys:
+                image_keys.append((face_name, face_image_id, -1))
 
-    # Cannot determine filetype.
-    if filetype is None and not has_magic_lib:
-        os.remove(outpath)
-        logger.error("Line {number}: Cannot determine file type: {url}".format(number=counter, url=url))
+        members = [("{name}_{image_id}.{ext}".format(name=name, image_id=image_id, ext=filetype), path, image_keys)]
+        for _, face_name, face_image_id, face_id, _ in faces:
+            if face_id in face_data:
+                member = "{name}_{image_id}_{face_id}.{ext}".format(name=face_name, image_id=face_image_id, face_id=face_id,
+                                                                    ext=(crop_options and crop_options.format) or filetype)
+                members.append((member, face_data[face_id], [(face_name, face_image_id, face_id)]))
+
+        try:
+            locations = shard_writer.add_sample(members)
+        except (IOError, OSError) as e:
+            logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+            return []
+        finally:
+            os.remove(path)
+
+        image_path = locations[0]
+        face_paths = dict(zip([member[2][0][2] for member in members[1:]], locations[1:]))
+        return [(face, image_path, face_paths.get(face[3])) for face in faces]
+
+    if not save_face:
+        return cropped({}, [])
+    if crop_pool is not None:
+        crop_pool.submit(lambda face_data, errors: on_saved(cropped(face_data, errors)), path, faces, None, filetype, crop_options)
+        return None
+    return cropped(*crop_faces(path, faces, None, filetype, crop_options))
+
+
+class CropQueue(object):
+    """Crop faces in a pool of processes without waiting for them
+
+    submit returns as soon as the crop is queued, so download threads go back
+    to downloading, and calls back with the result of crop_faces once it is
+    done. At most max_pending crops wait at a time; submit blocks while there
+    are more, so downloads do not get far ahead of cropping.
+
+    """
+
+    def __init__(self, workers, max_pending):
+        # Use spawn as forking a process that has running threads is unsafe
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, callback, image_path, faces, *args):
+        """Crop faces from the image at image_path with crop_faces(image_path, faces, *args),
+        then call callback(face_paths, errors) from the pool's thread"""
+
+        self.slots.acquire()
+
+        def done(future):
+            try:
+                try:
+                    result = future.result()
+                except Exception as e:  # E.g. a worker process died
+                    result = ({}, [(faces[0][0], "Cannot crop faces: {}".format(e))])
+                callback(*result)
+            except Exception as e:
+                logger = logging.getLogger("logger")
+                logger.error("Line {number}: {error}".format(number=faces[0][0], error=e), extra=line_fields(faces[0][0]))
+            finally:
+                self.slots.release()
+
+        try:
+            self.pool.submit(crop_faces, image_path, faces, *args).add_done_callback(done)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def shutdown(self):
+        """Wait for the crops queued and their callbacks"""
+
+        self.pool.shutdown()
+
+
+def next_shard_number(dirpath):
+    """Returns the number of the next tar shard in dirpath, after those already there"""
+
+    numbers = [int(f[len("shard-"):-len(".tar")]) for f in os.listdir(dirpath)
+               if f.startswith("shard-") and f.endswith(".tar")]
+    return max(numbers) + 1 if numbers else 0
+
+
+class ShardWriter(object):
+    """Append images and faces to uncompressed tar shards
+
+    Shards are written to datasetpath/shards/shard-NNNNNN.tar and a new one is
+    started once a shard reaches shard_size bytes. Next to each shard is an
+    index shard-NNNNNN.idx with one tab separated line per member:
+
+        name    image_id    face_id    offset    size    member
+
+    face_id is -1 for full images. offset is where the member's data starts in
+    the tar file, so it can be read with ShardReader (mmap) without extracting
+    or walking directories. Safe to use from several threads.
+
+    """
+
+    def __init__(self, datasetpath, shard_size):
+        self.datasetpath = datasetpath
+        self.dirpath = os.path.join(datasetpath, "shards")
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        self.tar = None
+        self.index = None
+        ensure_dir_exists(self.dirpath)
+
+        # Never append to shards of a previous run
+        self.number = next_shard_number(self.dirpath)
+
+    def _open(self):
+        filename = "shard-{:06d}".format(self.number)
+        self.number += 1
+        self.shard_path = os.path.join(self.dirpath, filename + ".tar")
+        self.tar = tarfile.open(self.shard_path, 'w', format=tarfile.PAX_FORMAT)
+        self.index = open(os.path.join(self.dirpath, filename + ".idx"), 'w')
+
+    def _close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.index.close()
+            self.tar = None
+            self.index = None
+
+    def add_sample(self, members):
+        """Append members next to each other in the same shard.
+
+        members is a list of (member name, data, keys) where data is bytes or a
+        path to a file, and keys is a list of (name, image_id, face_id) to index
+        the member under.
+
+        Returns the location of each member as shards/shard-NNNNNN.tar:member
+
+        """
+
+        with self.lock:
+            if self.tar is None or self.tar.offset >= self.shard_size:
+                self._close()
+                self._open()
+
+            locations = []
+            index_lines = []
+            for member, data, keys in members:
+                tarinfo = tarfile.TarInfo(member)
+                tarinfo.mtime = time.time()
+                if isinstance(data, bytes):
+                    tarinfo.size = len(data)
+                    self.tar.addfile(tarinfo, io.BytesIO(data))
+                else:
+                    tarinfo.size = os.path.getsize(data)
+                    with open(data, 'rb') as infile:
+                        self.tar.addfile(tarinfo, infile)
+
+                # Data is followed by padding to a multiple of the block size
+                padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                offset = self.tar.offset - padded_size
+                for name, image_id, face_id in keys:
+                    index_lines.append("{}\t{}\t{}\t{}\t{}\t{}\n".format(name, image_id, face_id, offset, tarinfo.size, member))
+                locations.append("{}:{}".format(self.shard_path, member))
+
+            # Index members only once all their bytes are written out, so that a
+            # killed run never indexes (or records in the manifest) a truncated member
+            self.tar.fileobj.flush()
+            self.index.writelines(index_lines)
+            self.index.flush()
+            return locations
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+class ShardReader(object):
+    """Read images and faces written by ShardWriter using mmap
+
+    All indexes are loaded up front, then get returns a sample without
+    extracting the tar files.
+
+    """
+
+    def __init__(self, datasetpath):
+        self.dirpath = os.path.join(datasetpath, "shards")
+        self.entries = {}  # (name, image_id, face_id) -> (shard path, offset, size)
+        self.maps = {}     # shard path -> mmap
+        for filename in sorted(os.listdir(self.dirpath)):
+            if not filename.endswith(".idx"):
+                continue
+            shard_path = os.path.join(self.dirpath, filename[:-len(".idx")] + ".tar")
+            with open(os.path.join(self.dirpath, filename)) as infile:
+                for line in infile:
+                    name, image_id, face_id, offset, size, member = line.rstrip('\n').split('\t')
+                    self.entries[(name, int(image_id), int(face_id))] = (shard_path, int(offset), int(size))
+
+    def keys(self):
+        """Returns the (name, image_id, face_id) of all samples. face_id is -1 for full images."""
+
+        return self.entries.keys()
+
+    def get(self, name, image_id, face_id=-1):
+        """Returns the encoded image as a memoryview into the shard. face_id -1 for the full image."""
+
+        shard_path, offset, size = self.entries[(name, image_id, face_id)]
+        if shard_path not in self.maps:
+            with open(shard_path, 'rb') as infile:
+                self.maps[shard_path] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.maps[shard_path])[offset:offset + size]
+
+
+class Manifest(object):
+    """Record of what happened to each face, kept in an SQLite database
+
+    Faces are keyed by (name, image_id, face_id) and stored with the line
+    number, url, status (e.g. "ok", "hash_mismatch", "http_404", "timeout")
+    and output paths relative to datasetpath. Reruns skip faces whose status
+    is "ok" with a single indexed lookup per face.
+
+    Safe to use from several threads. Records are committed in batches, so a
+    killed run loses at most commit_every records, which are downloaded again.
+
+    """
+
+    filename = "manifest.sqlite"
+    commit_every = 100
+
+    def __init__(self, datasetpath):
+        self.datasetpath = datasetpath
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(os.path.join(datasetpath, self.filename), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS faces (
+                               name TEXT, image_id INTEGER, face_id INTEGER, line INTEGER, url TEXT,
+                               status TEXT, image_path TEXT, face_path TEXT, updated REAL,
+                               PRIMARY KEY (name, image_id, face_id))""")
+        self.db.commit()
+
+    def is_done(self, face, need_face=False):
+        """Whether face was saved by a previous run. If need_face, its crop must have been saved too."""
+
+        counter, name, image_id, face_id, bbox = face
+        with self.lock:
+            row = self.db.execute("SELECT status, face_path FROM faces WHERE name=? AND image_id=? AND face_id=?",
+                                  (name, image_id, face_id)).fetchone()
+        return row is not None and row[0] == "ok" and (row[1] is not None or not need_face)
+
+    def status(self, face):
+        """Returns the status recorded for face, or None"""
+
+        counter, name, image_id, face_id, bbox = face
+        with self.lock:
+            row = self.db.execute("SELECT status FROM faces WHERE name=? AND image_id=? AND face_id=?",
+                                  (name, image_id, face_id)).fetchone()
+        return row[0] if row is not None else None
+
+    def skip_done(self, jobs, need_face=False):
+        """Yields jobs with the faces that were already saved removed"""
+
+        for url, sha256, faces in jobs:
+            faces = [face for face in faces if not self.is_done(face, need_face)]
+            if faces:
+                yield url, sha256, faces
+
+    def record(self, face, url, status, image_path=None, face_path=None):
+        counter, name, image_id, face_id, bbox = face
+        if image_path is not None:
+            image_path = os.path.relpath(image_path, self.datasetpath)
+        if face_path is not None:
+            face_path = os.path.relpath(face_path, self.datasetpath)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO faces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (name, image_id, face_id, counter, url, status, image_path, face_path, time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def rows(self):
+        """Returns all records as (name, image_id, face_id, line, url, status, image_path, face_path, updated)"""
+
+        with self.lock:
+            return self.db.execute("SELECT * FROM faces").fetchall()
+
+    def merge(self, row):
+        """Add a record from another manifest. A face recorded as "ok" is only replaced by another "ok" record."""
+
+        with self.lock:
+            self.db.execute("""INSERT INTO faces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                               ON CONFLICT (name, image_id, face_id) DO UPDATE SET
+                                   line=excluded.line, url=excluded.url, status=excluded.status, image_path=excluded.image_path,
+                                   face_path=excluded.face_path, updated=excluded.updated
+                               WHERE faces.status != 'ok' OR excluded.status = 'ok'""", row)
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, or copy it if they are on different filesystems"""
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class BlobCache(object):
+    """Content addressed store of downloaded images, keyed by their sha256
+
+    Images are kept in cachedir/<first 2 hex digits>/<sha256>, so the cache
+    can be shared by runs with different data files and dataset directories.
+    Images are hard linked in and out of the cache when it is on the same
+    filesystem, else copied. Once the cache holds more than max_size bytes,
+    the least recently used images are removed. The order of use is saved to
+    cachedir/lru.txt by close, so it carries over between runs. It is not kept
+    in the files' times, which hard linked copies in datasets share.
+
+    Only images whose sha256 matched are added. The hash is checked again on
+    the way out, as a hard linked copy may have been changed in place.
+    Safe to use from several threads.
+
+    """
+
+    order_filename = "lru.txt"
+
+    def __init__(self, cachedir, max_size):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.blobs = collections.OrderedDict()  # sha256 -> size, least recently used first
+        self.size = 0
+        ensure_dir_exists(cachedir)
+
+        # Images missing from the saved order, e.g. added by a run that was killed, count as used last
+        order = {}
+        try:
+            with open(os.path.join(cachedir, self.order_filename)) as f:
+                order = dict((line.strip(), rank) for rank, line in enumerate(f))
+        except FileNotFoundError:
+            pass
+        found = []
+        for dirname in os.listdir(cachedir):
+            dirpath = os.path.join(cachedir, dirname)
+            if len(dirname) != 2 or not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if len(filename) == 64:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    found.append((order.get(filename, len(order)), stat.st_mtime, filename, stat.st_size))
+        for _, _, sha256, size in sorted(found):
+            self.blobs[sha256] = size
+            self.size += size
+        self._evict()  # max_size may be smaller than in the previous run
+
+    def path(self, sha256):
+        return os.path.join(self.cachedir, sha256[:2], sha256)
+
+    def __contains__(self, sha256):
+        with self.lock:
+            return sha256 in self.blobs
+
+    def fetch(self, sha256, tmpdir):
+        """Link the cached image to a temporary file in tmpdir.
+        Returns a Download like download_image, or None if the image is not in the cache.
+        """
+
+        with self.lock:
+            if sha256 not in self.blobs:
+                return None
+            self.blobs.move_to_end(sha256)
+            size = self.blobs[sha256]
+
+        fd, path = tempfile.mkstemp(dir=tmpdir)
+        os.close(fd)
+        os.remove(path)
+        filetype = None
+        try:
+            link_or_copy(self.path(sha256), path)
+            with open(path, 'rb') as f:
+                filetype = guess_filetype(f.read(ImageStream.sniff_size))
+                f.seek(0)
+                # A hard linked copy in some dataset may have been changed. Hashing is cheap next to downloading.
+                if filetype is not None and hashfile(f) != sha256:
+                    filetype = None
+                    os.remove(self.path(sha256))
+        except OSError:  # Removed by another run sharing the cache
+            pass
+
+        if filetype is None:
+            with self.lock:
+                if self.blobs.pop(sha256, None) is not None:
+                    self.size -= size
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        return Download(path, "ok", None, filetype, size)
+
+    def add(self, path, sha256):
+        """Add the verified image at path to the cache"""
+
+        with self.lock:
+            if sha256 in self.blobs:
+                return
+
+        blob = self.path(sha256)
+        ensure_dir_exists(os.path.dirname(blob))
+        tmp = "{}.{}.tmp".format(blob, threading.get_ident())
+        link_or_copy(path, tmp)
+        os.replace(tmp, blob)  # Never leave a partial file under the final name
+        size = os.path.getsize(blob)
+
+        with self.lock:
+            if sha256 in self.blobs:
+                return
+            self.blobs[sha256] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used images until the cache fits in max_size. Call with lock held."""
+
+        while self.size > self.max_size and len(self.blobs) > 1:
+            sha256, size = self.blobs.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Save the order of use for the next run"""
+
+        path = os.path.join(self.cachedir, self.order_filename)
+        tmp = "{}.{}.tmp".format(path, os.getpid())  # Other runs may share the cache
+        with self.lock:
+            with open(tmp, 'w') as f:
+                f.writelines(sha256 + "\n" for sha256 in self.blobs)
+        os.replace(tmp, path)
+
+
+# Failures of a url that will not go away by trying again
+PERMANENT_STATUSES = frozenset(["http_404", "http_410"])
+
+# Failures that count towards giving up on a host
+HOST_FAILURE_STATUSES = frozenset(["timeout", "connection_error"])
+
+
+class DeadLinks(object):
+    """Remember urls and hosts that cannot be downloaded, so they fail without a request
+
+    A url that returned a status in PERMANENT_STATUSES is kept in
+    datasetpath/dead_links.sqlite and forgotten after expiry seconds, so later
+    runs skip it too but eventually try again.
+
+    A host is given up on (status "host_down") for the rest of the run after
+    max_failures different urls from it in a row fail with a status in
+    HOST_FAILURE_STATUSES, e.g. its name no longer resolves or it always times
+    out. Hosts are not remembered across runs, as the failures may have been
+    a network outage on this side. max_failures 0 never gives up on a host.
+    Safe to use from several threads.
+
+    """
+
+    filename = "dead_links.sqlite"
+    commit_every = 100
+
+    def __init__(self, datasetpath, max_failures=5, expiry=7 * 24 * 3600):
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.failures = collections.defaultdict(set)  # host -> urls that failed in a row
+        self.hosts = {}
+        self.uncommitted = 0
+        self.db = sqlite3.connect(os.path.join(datasetpath, self.filename), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, status TEXT, updated REAL)")
+        self.db.execute("DROP TABLE IF EXISTS hosts")  # Hosts given up on by older versions
+        self.db.execute("DELETE FROM urls WHERE updated < ?", (time.time() - expiry,))
+        self.db.commit()
+        self.urls = dict(self.db.execute("SELECT url, status FROM urls"))
+
+    def check(self, url):
+        """Returns the status url is known to fail with, or None"""
+
+        with self.lock:
+            return self.urls.get(url) or self.hosts.get(get_host(url))
+
+    def record(self, url, status):
+        """Update with the status of a download of url"""
+
+        host = get_host(url)
+        with self.lock:
+            if status in PERMANENT_STATUSES:
+                self.urls[url] = status
+                self._save(url, status)
+            if status not in HOST_FAILURE_STATUSES:  # The host answered
+                self.failures.pop(host, None)
+                return
+
+            # Retries of the same url count once
+            self.failures[host].add(url)
+            if 0 < self.max_failures <= len(self.failures[host]) and host not in self.hosts:
+                self.hosts[host] = "host_down"
+                logger = logging.getLogger("logger")
+                logger.error("Giving up on host {} after {} urls failed in a row".format(host, len(self.failures[host])),
+                             extra={"fields": {"host": host}})
+
+    def _save(self, url, status):
+        self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?)", (url, status, time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class HttpCache(object):
+    """Remember the Validators of urls downloaded, so reruns can ask servers for images only if they changed
+
+    Kept in datasetpath/http_cache.sqlite, with image paths relative to
+    datasetpath. Only urls whose server sent an ETag or Last-Modified header,
+    or that redirected, are kept. Safe to use from several threads.
+
+    """
+
+    filename = "http_cache.sqlite"
+    commit_every = 100
+
+    def __init__(self, datasetpath):
+        self.datasetpath = datasetpath
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(os.path.join(datasetpath, self.filename), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, final_url TEXT, "
+                        "sha256 TEXT, image_path TEXT, updated REAL)")
+        self.entries = dict((row[0], Validators(*row[1:]))
+                            for row in self.db.execute("SELECT url, etag, last_modified, final_url, sha256, image_path FROM urls"))
+
+    def get(self, url):
+        """Returns the Validators of url, or None"""
+
+        with self.lock:
+            validators = self.entries.get(url)
+        if validators is None or validators.image_path is None:
+            return validators
+        return validators._replace(image_path=os.path.join(self.datasetpath, validators.image_path))
+
+    def put(self, url, validators, image_path=None):
+        """Remember the Validators of url, whose image was saved to image_path"""
+
+        if not (validators.etag or validators.last_modified or validators.final_url):
+            self.forget(url)
+            return
+        if image_path is not None:
+            image_path = os.path.relpath(image_path, self.datasetpath)
+        validators = validators._replace(image_path=image_path)
+        with self.lock:
+            if self.entries.get(url) == validators:
+                return
+            self.entries[url] = validators
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?, ?)", (url,) + tuple(validators) + (time.time(),))
+            self._written()
+
+    def forget(self, url):
+        with self.lock:
+            if self.entries.pop(url, None) is not None:
+                self.db.execute("DELETE FROM urls WHERE url = ?", (url,))
+                self._written()
+
+    def _written(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def in_partition(sha256, index, count):
+    """Whether the image with hash sha256 belongs to part index of count, using a hash that is stable across runs and machines"""
+
+    return zlib.crc32(sha256.encode("ascii")) % count == index
+
+
+def select_partition(jobs, index, count):
+    """Yields the jobs that belong to part index of count
+
+    Whole jobs are assigned by their sha256, so an image listed under several
+    names or image_ids is only downloaded by one part.
+
+    """
+
+    for url, sha256, faces in jobs:
+        if in_partition(sha256, index, count):
+            yield url, sha256, faces
+
+
+def merge_datasets(datasetpath, sources, move=False):
+    """Merge datasets downloaded separately, e.g. by several machines using --num_parts, into datasetpath
+
+    Images and faces recorded as saved in the manifest of each source are
+    copied (or moved) to the same relative path in datasetpath. Tar shards are
+    copied under new numbers. The manifests are merged so that reruns in
+    datasetpath only download what no source has.
+
+    Returns a Counter of the number of records, files and shards merged.
+
+    """
+
+    ensure_dir_exists(datasetpath)
+    manifest = Manifest(datasetpath)
+    results = collections.Counter()
+    transfer = shutil.move if move else shutil.copyfile
+
+    for source in sources:
+        # Copy shards under new numbers, after those already in datasetpath
+        shard_names = {}
+        source_shards = os.path.join(source, "shards")
+        if os.path.isdir(source_shards):
+            shards_dirpath = os.path.join(datasetpath, "shards")
+            ensure_dir_exists(shards_dirpath)
+            number = next_shard_number(shards_dirpath)
+            for filename in sorted(os.listdir(source_shards)):
+                if not (filename.startswith("shard-") and filename.endswith(".tar")):
+                    continue
+                new_filename = "shard-{:06d}".format(number)
+                number += 1
+                transfer(os.path.join(source_shards, filename), os.path.join(shards_dirpath, new_filename + ".tar"))
+                index = os.path.join(source_shards, filename[:-len(".tar")] + ".idx")
+                if os.path.exists(index):
+                    transfer(index, os.path.join(shards_dirpath, new_filename + ".idx"))
+                shard_names[os.path.join("shards", filename)] = os.path.join("shards", new_filename + ".tar")
+                results["shards"] += 1
+
+        def merge_path(path):
+            if path is None:
+                return None
+            if ".tar:" in path:  # Inside a shard
+                shard, member = path.split(".tar:", 1)
+                return "{}:{}".format(shard_names.get(shard + ".tar", shard + ".tar"), member)
+
+            source_path = os.path.join(source, path)
+            dest_path = os.path.join(datasetpath, path)
+            if os.path.exists(source_path) and not os.path.exists(dest_path):
+                ensure_dir_exists(os.path.dirname(dest_path))
+                transfer(source_path, dest_path)
+                results["files"] += 1
+            return path
+
+        source_manifest = Manifest(source)
+        for row in source_manifest.rows():
+            name, image_id, face_id, line, url, status, image_path, face_path, updated = row
+            if status == "ok":
+                image_path, face_path = merge_path(image_path), merge_path(face_path)
+            manifest.merge((name, image_id, face_id, line, url, status, image_path, face_path, updated))
+            results["records"] += 1
+        source_manifest.close()
+
+    manifest.close()
+    return results
+
+
+def merge_main(argv):
+    """Command line for merge_datasets"""
+
+    parser = argparse.ArgumentParser(prog="python3_download_facescrub.py merge",
+                                     description="Merge FaceScrub datasets downloaded separately (e.g. with --num_parts) into one")
+    parser.add_argument("datasetpath", help="Directory to merge the datasets into", type=str)
+    parser.add_argument("sources", help="Dataset directories to merge", type=str, nargs='+')
+    parser.add_argument("--move", help="Move files instead of copying them. Faster if on the same filesystem", dest="move",
+                        action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    results = merge_datasets(args.datasetpath, args.sources, args.move)
+    print("Merged {} records, {} files and {} shards into {}".format(results["records"], results["files"], results["shards"],
+                                                                      args.datasetpath))
+    return results
+
+
+class DigestIndex(object):
+    """sha256 of the files of a dataset, kept in datasetpath/digests.sqlite
+
+    A digest is only returned while the file has the size and modification
+    time it had when the digest was computed, so unchanged files need not be
+    read again. Safe to use from several threads.
+
+    """
+
+    filename = "digests.sqlite"
+    commit_every = 100
+
+    def __init__(self, datasetpath):
+        self.datasetpath = datasetpath
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.db = sqlite3.connect(os.path.join(datasetpath, self.filename), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)")
+        self.db.commit()
+
+    def get(self, path, stat):
+        """Returns the digest of the file at path given its os.stat, or None if it is not known or the file changed"""
+
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, sha256 FROM files WHERE path=?",
+                                  (os.path.relpath(path, self.datasetpath),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return row[2]
+
+    def put(self, path, stat, sha256):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                            (os.path.relpath(path, self.datasetpath), stat.st_size, stat.st_mtime_ns, sha256))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def check_file(path, digest_index, decode=False):
+    """Returns the sha256 of the file at path, or None if it is missing or, if decode, cannot be decoded as an image.
+    Files whose digest is in digest_index and that have not changed since are not read.
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    sha256 = digest_index.get(path, stat)
+    if sha256 is not None:
+        return sha256
+
+    with open(path, 'rb') as f:
+        sha256 = hashfile(f)
+    if decode:
+        try:
+            with Image.open(path) as I:
+                I.load()
+        except (IOError, SyntaxError, ValueError):  # Only images that decode are remembered
+            return None
+    digest_index.put(path, stat, sha256)
+    return sha256
+
+
+def find_files(dirpath, parts):
+    """Returns {key: path} for files in dirpath/<name>/ named <name>_<number>[_<number>].<ext>
+
+    parts is the number of numbers after the name: 1 for images, keyed by
+    (name, image_id), and 2 for faces, keyed by (name, image_id, face_id).
+
+    """
+
+    files = {}
+    if not os.path.isdir(dirpath):
+        return files
+    for name in os.listdir(dirpath):
+        name_dir = os.path.join(dirpath, name)
+        if not os.path.isdir(name_dir):
+            continue
+        for filename in os.listdir(name_dir):
+            stem = filename.rsplit('.', 1)[0]
+            if not stem.startswith(name + "_"):
+                continue
+            numbers = stem[len(name) + 1:].split('_')
+            if len(numbers) == parts and all(number.isdigit() for number in numbers):
+                files[(name,) + tuple(int(number) for number in numbers)] = os.path.join(name_dir, filename)
+    return files
+
+
+def verify_dataset(data, datasetpath, crop_face=False, workers=None):
+    """Check the images (and faces if crop_face) in datasetpath against the DataFile data
+
+    Images are hashed in parallel by workers threads and compared to their
+    sha256. Faces must decode. Files that have not changed since they were
+    last checked are not read again. The manifest is updated to match, so
+    that a download afterwards fetches exactly the missing and corrupt images.
+    Images saved to tar shards are not checked and their records are left alone.
+
+    Returns (results, bad_files, download_rows, crop_rows). results is a
+    Counter of images and faces by outcome, bad_files is a list of the paths of
+    corrupt files, download_rows are the rows of data whose image is missing or
+    corrupt and crop_rows are those whose face is missing or corrupt but whose
+    image is fine, so they can be cropped again without downloading.
+
+    """
+
+    logger = logging.getLogger("logger")
+    images = find_files(os.path.join(datasetpath, "images"), 1)
+    face_files = find_files(os.path.join(datasetpath, "faces"), 2) if crop_face else {}
+
+    # Faces of each image
+    expected = collections.OrderedDict()  # (name, image_id) -> (url, sha256, faces)
+    rows = {}  # (name, image_id, face_id) -> row
+    for row in range(len(data)):
+        face = data.face(row)
+        rows[(face[1], face[2], face[3])] = row
+        key = (face[1], face[2])
+        if key not in expected:
+            expected[key] = (data.urls[row], data.sha256s[row], [])
+        expected[key][2].append(face)
+
+    manifest = Manifest(datasetpath)
+    in_shards = set((row[0], row[1], row[2]) for row in manifest.rows()
+                    if row[5] == "ok" and row[6] is not None and ".tar:" in row[6])
+    digest_index = DigestIndex(datasetpath)
+    results = collections.Counter()
+    bad_files = []
+    download_rows = []
+    crop_rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = dict((key, executor.submit(check_file, images[key], digest_index)) for key in expected if key in images)
+        face_digests = dict((key, executor.submit(check_file, path, digest_index, True)) for key, path in face_files.items())
+
+        for key, (url, sha256, faces) in expected.items():
+            counter = faces[0][0]
+            image_path = images.get(key)
+            if image_path is None and any((face[1], face[2], face[3]) in in_shards for face in faces):
+                results["images in shards"] += 1
+                faces = [face for face in faces if (face[1], face[2], face[3]) not in in_shards]
+                if not faces:
+                    continue
+            if image_path is None:
+                # Saved before, possibly already found missing or corrupt by an earlier check
+                if not any(manifest.status(face) in ("ok", "missing", "corrupt") for face in faces):
+                    results["images not downloaded"] += 1
+                    continue
+                status = "missing"
+                logger.error("Line {number}: Image missing: {url}".format(number=counter, url=url), extra=line_fields(counter, url))
+            elif digests[key].result() != sha256:
+                status = "corrupt"
+                bad_files.append(image_path)
+                logger.error("Line {number}: Image corrupt, SHA 256 hash different: {path}".format(number=counter, path=image_path),
+                             extra=line_fields(counter, url))
+            else:
+                status = "ok"
+            results["images " + status] += 1
+
+            for face in faces:
+                if status != "ok":
+                    manifest.record(face, url, status)
+                    download_rows.append(rows[(face[1], face[2], face[3])])
+                    continue
+                if not crop_face:
+                    if not manifest.is_done(face):
+                        manifest.record(face, url, "ok", image_path)
+                    continue
+
+                face_path = face_files.get((face[1], face[2], face[3]))
+                if face_path is None:
+                    face_status = "crop_missing"
+                elif face_digests[(face[1], face[2], face[3])].result() is None:
+                    face_status = "crop_corrupt"
+                    bad_files.append(face_path)
+                else:
+                    face_status = "ok"
+                results["faces " + face_status.replace("crop_", "")] += 1
+                if face_status != "ok":
+                    logger.error("Line {number}: Face {status}: {url}".format(number=face[0], status=face_status[len("crop_"):], url=url),
+                                 extra=line_fields(face[0], url))
+                    manifest.record(face, url, face_status)
+                    crop_rows.append(rows[(face[1], face[2], face[3])])
+                elif not manifest.is_done(face, need_face=True):
+                    manifest.record(face, url, "ok", image_path, face_path)
+
+    digest_index.close()
+    manifest.close()
+    return results, bad_files, download_rows, crop_rows
+
+
+def verify_main(argv, repair=False):
+    """Command line for verify_dataset. If repair, missing and corrupt faces of good images are cropped again
+    and missing and corrupt images are downloaded again."""
+
+    command = "repair" if repair else "verify"
+    parser = argparse.ArgumentParser(prog="python3_download_facescrub.py " + command,
+                                     description="Check the images in a FaceScrub dataset against the data file" +
+                                                 (" and download the missing and corrupt ones again" if repair else ""),
+                                     epilog="Other arguments are passed to the download" if repair else None)
+    parser.add_argument("inputfile", help="FaceScrub data file. E.g., actors_users_normal_bbox.txt", type=str)
+    parser.add_argument("datasetpath", help="Directory the images were saved to", type=str)
+    parser.add_argument("--crop_face", help="Check face images too", dest="crop_face", action="store_true", default=False)
+    parser.add_argument('-l', '--logfile', type=str, help="File to log operations", action="store", required=False, dest="logfile", default="download.log")
+    parser.add_argument('-w', '--workers', type=int, help="Number of files to check at the same time. Default: a few more than the number of CPUs",
+                        action="store", required=False, dest="workers", default=None)
+    if repair:
+        args, download_argv = parser.parse_known_args(argv)
+    else:
+        args, download_argv = parser.parse_args(argv), []
+    assert args.workers is None or args.workers >= 1, "workers must be >= 1"
+
+    create_logger(args.logfile)
+    logger = logging.getLogger("logger")
+    if os.path.isdir(os.path.join(args.datasetpath, "shards")):
+        logger.info("Images in shards are not checked")
+
+    with open(args.inputfile) as infile:
+        data = DataFile(enumerate(islice(infile, 1, None), 2))  # Skip the header
+    results, bad_files, download_rows, crop_rows = verify_dataset(data, args.datasetpath, args.crop_face, args.workers)
+    logger.info("Verified: " + ", ".join("{} {}".format(count, outcome) for outcome, count in sorted(results.items())))
+
+    if not repair:
+        return results
+
+    for path in bad_files:
+        os.remove(path)
+
+    # Faces whose image is fine only need cropping. Use the same crop arguments as the download.
+    if crop_rows:
+        crop_parser = argparse.ArgumentParser(add_help=False)
+        add_crop_arguments(crop_parser)
+        crop_args, _ = crop_parser.parse_known_args(download_argv)
+        cropped = crop_dataset(data, args.datasetpath, parse_crop_arguments(crop_args), args.workers, crop_rows)
+        logger.info("Cropped {} faces again, {} failed".format(cropped["faces cropped"], cropped["faces failed"]))
+
+    # Only download the images found missing or corrupt, not every line that failed before
+    lines = set(data.lines[row] for row in download_rows)
+    if not lines:
+        logger.info("No images to download")
+        return collections.Counter()
+    return main([args.inputfile, args.datasetpath, "--logfile", args.logfile] + (["--crop_face"] if args.crop_face else []) +
+                download_argv, lines)
+
+
+def add_crop_arguments(parser, encode=True):
+    """Add the arguments that set CropOptions to parser. If not encode, leave out those for the output format."""
+
+    parser.add_argument('--face_padding', type=float, help="Fraction (float) of the bounding box's width and height to add around each face",
+                        action="store", required=False, dest="face_padding", default=0)
+    parser.add_argument('--face_size', type=str, help="Resize faces to WIDTHxHEIGHT, e.g. 128x128. The box is grown to the same aspect ratio first",
+                        action="store", required=False, dest="face_size", default=None)
+    if not encode:
+        return
+    parser.add_argument('--face_format', type=str, help="Save faces in this format, e.g. jpeg, png or webp. Default: same as the image",
+                        action="store", required=False, dest="face_format", default=None)
+    parser.add_argument('--face_quality', type=int, help="Quality (1 to 100) of faces saved as jpeg or webp",
+                        action="store", required=False, dest="face_quality", default=None)
+
+
+def parse_crop_arguments(args):
+    """Returns CropOptions from the arguments added by add_crop_arguments"""
+
+    assert args.face_padding >= 0, "face_padding must be >= 0"
+    size = None
+    if args.face_size is not None:
+        try:
+            size = tuple(int(n) for n in args.face_size.lower().split('x'))
+        except ValueError:
+            size = ()
+        assert len(size) == 2 and min(size) >= 1, "face_size must be WIDTHxHEIGHT, e.g. 128x128"
+    face_format = args.face_format.lower().lstrip('.') if getattr(args, "face_format", None) else None
+    if face_format == "jpg":
+        face_format = "jpeg"
+    assert face_format is None or '.' + face_format in Image.registered_extensions(), "face_format is not a format Pillow can save"
+    face_quality = getattr(args, "face_quality", None)
+    assert face_quality is None or 1 <= face_quality <= 100, "face_quality must be between 1 and 100"
+    return CropOptions(args.face_padding, size, face_format, face_quality)
+
+
+def crop_dataset(data, datasetpath, options, workers=None, rows=None):
+    """Crop the faces of the DataFile data (only those in rows, if given) again from the images already in datasetpath/images
+
+    Images are cropped in parallel in workers processes, and nothing is
+    downloaded. Face images from earlier crops are replaced, and the manifest
+    records the new ones.
+
+    Returns a Counter of the number of images and faces cropped and failed.
+
+    """
+
+    logger = logging.getLogger("logger")
+    images = find_files(os.path.join(datasetpath, "images"), 1)
+    old_faces = find_files(os.path.join(datasetpath, "faces"), 2)
+
+    jobs = collections.OrderedDict()  # image_path -> (url, faces)
+    results = collections.Counter()
+    for row in (range(len(data)) if rows is None else rows):
+        face = data.face(row)
+        image_path = images.get((face[1], face[2]))
+        if image_path is None:
+            results["faces without image"] += 1
+            continue
+        if image_path not in jobs:
+            jobs[image_path] = (data.urls[row], [])
+        jobs[image_path][1].append(face)
+
+    manifest = Manifest(datasetpath)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        paths = list(jobs)
+        filetypes = [path.rsplit('.', 1)[-1] for path in paths]
+        cropped = executor.map(crop_faces, paths, [jobs[path][1] for path in paths], [datasetpath] * len(paths), filetypes,
+                               [options] * len(paths), chunksize=8)
+        for image_path, (face_paths, errors) in zip(paths, cropped):
+            url, faces = jobs[image_path]
+            results["images cropped"] += 1
+            for face_counter, error in errors:
+                logger.error("Line {number}: {error}: {url}".format(number=face_counter, error=error, url=url), extra=line_fields(face_counter, url))
+            for face in faces:
+                face_path = face_paths.get(face[3])
+                old_path = old_faces.get((face[1], face[2], face[3]))
+                if face_path is None:
+                    results["faces failed"] += 1
+                    manifest.record(face, url, "crop_error", image_path)
+                    continue
+                if old_path is not None and old_path != face_path:  # Saved in another format before
+                    os.remove(old_path)
+                results["faces cropped"] += 1
+                manifest.record(face, url, "ok", image_path, face_path)
+
+    manifest.close()
+    return results
+
+
+def crop_main(argv):
+    """Command line for crop_dataset"""
+
+    parser = argparse.ArgumentParser(prog="python3_download_facescrub.py crop",
+                                     description="Crop faces again from the images of a FaceScrub dataset, without downloading")
+    parser.add_argument("inputfile", help="FaceScrub data file. E.g., actors_users_normal_bbox.txt", type=str)
+    parser.add_argument("datasetpath", help="Directory the images were saved to. Faces are saved to datasetpath/faces", type=str)
+    parser.add_argument('-l', '--logfile', type=str, help="File to log operations", action="store", required=False, dest="logfile", default="download.log")
+    parser.add_argument('-w', '--workers', type=int, help="Number of processes that crop faces. Default: number of CPUs",
+                        action="store", required=False, dest="workers", default=None)
+    parser.add_argument('--names', type=str, help="Only crop faces of these people, separated by commas, as named in the data file",
+                        action="store", required=False, dest="names", default=None)
+    add_crop_arguments(parser)
+    args = parser.parse_args(argv)
+    assert args.workers is None or args.workers >= 1, "workers must be >= 1"
+    options = parse_crop_arguments(args)
+
+    create_logger(args.logfile)
+    logger = logging.getLogger("logger")
+    with open(args.inputfile) as infile:
+        data = DataFile(enumerate(islice(infile, 1, None), 2))  # Skip the header
+    rows = None
+    if args.names is not None:
+        rows = data.select([name.strip() for name in args.names.split(',') if name.strip()])
+
+    start = time.monotonic()
+    results = crop_dataset(data, args.datasetpath, options, args.workers, rows)
+    logger.info("Cropped {} faces from {} images in {:.1f} seconds. {} faces failed, {} faces have no image".format(
+        results["faces cropped"], results["images cropped"], time.monotonic() - start, results["faces failed"],
+        results["faces without image"]))
+    return results
+
+
+def face_pixels(image_path, faces, options):
+    """Crop faces from the image at image_path and resize them to options.size
+
+    Runs in a worker process like crop_faces. Returns (pixels, errors), where
+    pixels maps face_id to the face's RGB pixels as bytes, row by row.
+
+    """
+
+    pixels = {}
+    errors = []
+    try:
+        I, boxes = load_faces(image_path, faces, options)
+    except IOError as e:
+        return pixels, [(faces[0][0], str(e))]
+
+    for (face_counter, _, _, face_id, _), box in zip(faces, boxes):
+        try:
+            face = I.crop(box)
+            if face.mode != "RGB":
+                face = face.convert("RGB")
+            pixels[face_id] = face.resize(tuple(options.size), Image.LANCZOS, reducing_gap=3.0).tobytes()
+        except (IOError, ValueError) as e:
+            errors.append((face_counter, str(e)))
+    return pixels, errors
+
+
+# Size of the header of .npy files written here. Leaves room to rewrite the shape once it is known.
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(descr, shape):
+    """Returns the header of a .npy file (format version 1.0) of a C order array of dtype descr and shape"""
+
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(descr, repr(tuple(shape)))
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def write_npy_ints(path, values):
+    """Write values to path as a .npy array of int64"""
+
+    values = array.array('q', values)
+    with open(path, 'wb') as f:
+        f.write(npy_header("<i8" if sys.byteorder == "little" else ">i8", (len(values),)))
+        values.tofile(f)
+
+
+def write_npy_strings(path, values):
+    """Write values to path as a .npy array of unicode strings"""
+
+    width = max([len(value) for value in values] + [1])
+    with open(path, 'wb') as f:
+        f.write(npy_header("<U{}".format(width), (len(values),)))
+        for value in values:
+            f.write(value.encode("utf-32-le").ljust(4 * width, b"\0"))
+
+
+def export_faces(data, datasetpath, outputdir, options, workers=None, rows=None):
+    """Write the faces of the DataFile data (only those in rows, if given) to arrays in outputdir
+
+    Faces are cropped from the images in datasetpath/images in parallel in
+    workers processes and resized to options.size. They are written as they
+    are cropped to faces.npy, a uint8 array of shape (faces, height, width, 3),
+    so memory does not grow with the number of faces. Next to it:
+
+        labels.npy      int64 index of each face's name in names.npy
+        names.npy       names of the people, sorted
+        image_ids.npy   int64 image_id of each face
+        face_ids.npy    int64 face_id of each face
+        names.json      name to label mapping
+
+    The .npy files are written without numpy, but can be read with
+    numpy.load(path, mmap_mode="r") to slice batches without copying.
+
+    Returns a Counter of the number of faces exported and failed.
+
+    """
+
+    logger = logging.getLogger("logger")
+    images = find_files(os.path.join(datasetpath, "images"), 1)
+    ensure_dir_exists(outputdir)
+
+    jobs = collections.OrderedDict()  # image_path -> (url, faces)
+    results = collections.Counter()
+    for row in (range(len(data)) if rows is None else rows):
+        face = data.face(row)
+        image_path = images.get((face[1], face[2]))
+        if image_path is None:
+            results["faces without image"] += 1
+            continue
+        if image_path not in jobs:
+            jobs[image_path] = (data.urls[row], [])
+        jobs[image_path][1].append((face, data.names[row]))
+
+    names, image_ids, face_ids = [], array.array('q'), array.array('q')
+    width, height = options.size
+    with open(os.path.join(outputdir, "faces.npy"), 'wb') as f:
+        f.write(npy_header("|u1", (0, height, width, 3)))  # Rewritten once the number of faces is known
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            paths = list(jobs)
+            exported = executor.map(face_pixels, paths, [[face for face, _ in jobs[path][1]] for path in paths],
+                                    [options] * len(paths), chunksize=8)
+            for image_path, (pixels, errors) in zip(paths, exported):
+                url, faces = jobs[image_path]
+                for face_counter, error in errors:
+                    logger.error("Line {number}: {error}: {url}".format(number=face_counter, error=error, url=url),
+                                 extra=line_fields(face_counter, url))
+                for face, name in faces:
+                    if face[3] not in pixels:
+                        results["faces failed"] += 1
+                        continue
+                    f.write(pixels[face[3]])
+                    names.append(name)
+                    image_ids.append(face[2])
+                    face_ids.append(face[3])
+                    results["faces exported"] += 1
+        f.seek(0)
+        f.write(npy_header("|u1", (len(names), height, width, 3)))
+
+    labels = dict((name, label) for label, name in enumerate(sorted(set(names))))
+    write_npy_ints(os.path.join(outputdir, "labels.npy"), [labels[name] for name in names])
+    write_npy_strings(os.path.join(outputdir, "names.npy"), sorted(labels))
+    write_npy_ints(os.path.join(outputdir, "image_ids.npy"), image_ids)
+    write_npy_ints(os.path.join(outputdir, "face_ids.npy"), face_ids)
+    with open(os.path.join(outputdir, "names.json"), 'w') as f:
+        json.dump(labels, f, indent=1, sort_keys=True)
+    return results
+
+
+def export_main(argv):
+    """Command line for export_faces"""
+
+    parser = argparse.ArgumentParser(prog="python3_download_facescrub.py export",
+                                     description="Export the faces of a FaceScrub dataset to memory mappable arrays for training")
+    parser.add_argument("inputfile", help="FaceScrub data file. E.g., actors_users_normal_bbox.txt", type=str)
+    parser.add_argument("datasetpath", help="Directory the images were saved to", type=str)
+    parser.add_argument("outputdir", help="Directory to write the arrays to", type=str)
+    parser.add_argument('-l', '--logfile', type=str, help="File to log operations", action="store", required=False, dest="logfile", default="download.log")
+    parser.add_argument('-w', '--workers', type=int, help="Number of processes that crop faces. Default: number of CPUs",
+                        action="store", required=False, dest="workers", default=None)
+    parser.add_argument('--names', type=str, help="Only export faces of these people, separated by commas, as named in the data file",
+                        action="store", required=False, dest="names", default=None)
+    add_crop_arguments(parser, encode=False)
+    parser.set_defaults(face_size="112x112")
+    args = parser.parse_args(argv)
+    assert args.workers is None or args.workers >= 1, "workers must be >= 1"
+    options = parse_crop_arguments(args)
+
+    create_logger(args.logfile)
+    logger = logging.getLogger("logger")
+    with open(args.inputfile) as infile:
+        data = DataFile(enumerate(islice(infile, 1, None), 2))  # Skip the header
+    rows = None
+    if args.names is not None:
+        rows = data.select([name.strip() for name in args.names.split(',') if name.strip()])
+
+    start = time.monotonic()
+    results = export_faces(data, args.datasetpath, args.outputdir, options, args.workers, rows)
+    logger.info("Exported {} faces to {} in {:.1f} seconds. {} faces failed, {} faces have no image".format(
+        results["faces exported"], args.outputdir, time.monotonic() - start, results["faces failed"], results["faces without image"]))
+    return results
+
+
+def finish_download(job, download, manifest, args, crop_pool=None, shard_writer=None, blob_cache=None, http_cache=None):
+    """Save a downloaded image and record the outcome for each of its faces in the manifest.
+
+    download is the Download returned by download_image.
+    Faces are cropped in crop_pool, a CropQueue, if given, in which case the
+    faces are recorded once they are cropped. Images are appended to the shards
+    of shard_writer if given, and kept in blob_cache if given. The download's
+    validators are remembered in http_cache if given.
+    Returns True if the image was saved (or is being saved with its faces) else False
+
+    """
+
+    url, sha256, faces = job
+    if download.path is None:
+        for face in faces:
+            manifest.record(face, url, download.status)
         return False
 
-    # Get filetype using lib magic
-    elif filetype is None and has_magic_lib:
-        mimetype = magic.from_buffer(response.content, mime=True)
-        if mimetype is None:
-            logger.error("Line {number}: Cannot determine file type: {url}".format(number=counter, url=url))
+    if blob_cache is not None:
+        try:
+            blob_cache.add(download.path, sha256)
+        except OSError as e:  # The image can still be saved
+            logger = logging.getLogger("logger")
+            logger.error("Line {number}: Cannot add to cache: {error}: {url}".format(number=faces[0][0], error=e, url=url),
+                         extra=line_fields(faces[0][0], url))
+
+    def record_saved(saved):
+        if not saved:
+            for face in faces:
+                manifest.record(face, url, "save_error")
             return False
 
-        ext = mimetypes.guess_extension(mimetype).lstrip('.')
-        if ext is None:
-            logger.error("Line {number}: Cannot determine file type: {url}".format(number=counter, url=url))
-            return False
-        elif ext == "jpe":
-            filetype = "jpeg"
+        for face, image_path, face_path in saved:
+            status = "ok" if face_path is not None or not args.crop_face else "crop_error"
+            manifest.record(face, url, status, image_path, face_path)
+        if http_cache is not None and download.validators is not None:
+            http_cache.put(url, download.validators, saved[0][1] if shard_writer is None else None)
+        return True
 
-    # Rename file to have extension
-    newpath = "{}.{}".format(outpath, filetype)
-    shutil.move(outpath, newpath)
+    saved = save_image(faces[0][0], url, download.path, download.filetype, args.datasetpath, faces, save_face=args.crop_face,
+                       crop_pool=crop_pool, shard_writer=shard_writer, crop_options=args.crop_options, on_saved=record_saved)
+    return True if saved is None else record_saved(saved)
 
-    # If user wants face images
-    if save_face:
+
+async def run_async(scheduler, jobs, manifest, args, crop_pool=None, shard_writer=None, blob_cache=None, dead_links=None,
+                    http_cache=None):
+    """Download jobs from a HostScheduler concurrently on a single event loop
+
+    jobs are fed to the scheduler from a separate thread.
+    Returns a Counter of the number of images saved and failed.
+
+    """
+
+    logger = logging.getLogger("logger")
+    loop = asyncio.get_running_loop()
+    save_slots = asyncio.Semaphore(args.max_pending_saves)
+
+    # Keep-alive connections are reused across downloads from the same host
+    connector = aiohttp.TCPConnector(limit=args.concurrency, limit_per_host=args.max_per_host,
+                                     use_dns_cache=args.dns_ttl > 0, ttl_dns_cache=args.dns_ttl or None)
+
+    # Count connections like CountingHTTPAdapter. Every request, including redirects, takes a connection.
+    async def on_connection_create_end(client, context, params):
+        metrics.inc("connections_total")
+        metrics.inc("http_requests_total")
+
+    async def on_connection_reuseconn(client, context, params):
+        metrics.inc("http_requests_total")
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+    # Idle workers wait to be woken one at a time, when the scheduler may have a job ready or when the
+    # earliest host becomes free of its rate limit, rather than all of them polling the scheduler
+    idle = collections.deque()  # Futures of idle workers
+    timer = None
+
+    def wake_one():
+        while idle:
+            future = idle.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+
+    def on_timer():
+        nonlocal timer
+        timer = None
+        wake_one()
+
+    def wake_after(wait):
+        nonlocal timer
+        when = loop.time() + wait
+        if timer is None or timer.when() > when:
+            if timer is not None:
+                timer.cancel()
+            timer = loop.call_at(when, on_timer)
+
+    scheduler.on_change = lambda: loop.call_soon_threadsafe(wake_one)
+
+    async with aiohttp.ClientSession(connector=connector, trace_configs=[trace_config]) as client:
+
+        async def worker():
+            results = collections.Counter()
+            while True:
+                job, wait = scheduler.next_job()
+                if job is None:
+                    if wait is None:
+                        wake_one()  # So that the other workers find out too
+                        return results
+                    wake_after(wait)
+                    future = loop.create_future()
+                    idle.append(future)
+                    await future
+                    continue
+                wake_one()  # More jobs may be ready
+
+                url, sha256, faces = job
+                counter = faces[0][0]
+                download = None
+                if blob_cache is not None:
+                    download = await loop.run_in_executor(None, blob_cache.fetch, sha256, args.tmpdir)
+                if download is not None:
+                    logger.info("Line {number}: Found in cache: {url}".format(number=counter, url=url), extra=line_fields(counter, url))
+                    metrics.inc("cache_hits_total")
+                    scheduler.done(job)
+                    delay = None
+                elif dead_links is not None and dead_links.check(url) is not None:
+                    download = Download(None, dead_links.check(url), None, error="DeadLink")
+                    logger.error("Line {number}: Skipped, known to fail with {status}: {url}".format(number=counter, status=download.status, url=url),
+                                 extra=line_fields(counter, url))
+                    metrics.inc("dead_links_skipped_total", status=download.status)
+                    scheduler.done(job, download.status)
+                    delay = None
+                else:
+                    download = Download(None, "error", None)
+                    start = time.monotonic()
+                    metrics.add("in_flight", 1)
+                    try:
+                        logger.info("Processing line {}: {}".format(counter, url), extra=line_fields(counter, url))
+                        download = await download_image_async(client, counter, url, sha256, (args.connect_timeout, args.read_timeout),
+                                                              args.tmpdir, args.max_size, args.max_retries, args.deadline or None,
+                                                              http_cache.get(url) if http_cache is not None else None)
+                    finally:
+                        metrics.add("in_flight", -1)
+                        record_download(counter, url, download, time.monotonic() - start)
+                        if dead_links is not None:
+                            dead_links.record(url, download.status)
+                        delay = scheduler.done(job, download.status, download.retry_after)
+                if delay is not None:
+                    logger.info("Line {number}: Retrying in {delay:.1f} seconds: {url}".format(number=counter, delay=delay, url=url), extra=line_fields(counter, url))
+                    continue
+                if download.path is None:
+                    finish_download(job, download, manifest, args)
+                    results["failed"] += 1
+                    metrics.inc("images_total", result="failed")
+                    continue
+                try:
+                    # Writing and cropping block, so keep them off the event loop
+                    async with save_slots:
+                        saved = await loop.run_in_executor(None, finish_download, job, download, manifest, args, crop_pool,
+                                                           shard_writer, blob_cache, http_cache)
+                except Exception as e:
+                    logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url), extra=line_fields(counter, url))
+                    saved = False
+                results["saved" if saved else "failed"] += 1
+                metrics.inc("images_total", result="saved" if saved else "failed")
+
+        producer = threading.Thread(target=scheduler.feed, args=(jobs,), daemon=True)
+        producer.start()
+        results = collections.Counter()
         try:
-            I = Image.open(newpath)
-            output_dir = os.path.join(datasetpath, "faces", name)
-            ensure_dir_exists(output_dir)
-            filename = "{name}_{image_id}_{face_id}.{ext}".format(name=name,
-                                                                  image_id=image_id,
-                                                                  face_id=face_id,
-                                                                  ext=filetype)
-            I.crop(bbox).save(os.path.join(output_dir, filename))
-        except IOError as e:
-            logger.error("Line {number}: {error}: {url}".format(number=counter, error=e, url=url))
-            return False
+            for worker_results in await asyncio.gather(*[worker() for _ in range(args.concurrency)]):
+                results.update(worker_results)
+        finally:
+            scheduler.on_change = None  # The loop is about to close
+        return results
+
+
+def run_threads(scheduler, jobs, manifest, args, crop_pool=None, shard_writer=None, blob_cache=None, dead_links=None,
+                http_cache=None):
+    """Download jobs from a HostScheduler with a pool of threads
 
-    return True
+    The calling thread feeds jobs to the scheduler while the pool downloads them.
+    Returns a Counter of the number of images saved and failed.
 
+    """
+
+    logger = logging.getLogger("logger")
 
-def main():
-    parser = argparse.ArgumentParser(description="Script to download FaceScrub dataset")
+    def _f(url, sha256, faces, args):
+        counter = faces[0][0]
+        download = blob_cache.fetch(sha256, args.tmpdir) if blob_cache is not None else None
+        if download is not None:
+            logger.info("Line {number}: Found in cache: {url}".format(number=counter, url=url), extra=line_fields(counter, url))
+            metrics.inc("cache_hits_total")
+            scheduler.done((url, sha256, faces))
+            return finish_download((url, sha256, faces), download, manifest, args, crop_pool, shard_writer)
+
+        status = dead_links.check(url) if dead_links is not None else None
+        if status is not None:
+            logger.error("Line {number}: Skipped, known to fail with {status}: {url}".format(number=counter, status=status, url=url),
+                         extra=line_fields(counter, url))
+            metrics.inc("dead_links_skipped_total", status=status)
+            scheduler.done((url, sha256, faces), status)
+            return finish_download((url, sha256, faces), Download(None, status, None, error="DeadLink"), manifest, args)
+
+        logger.info("Processing line {}: {}".format(counter, url), extra=line_fields(counter, url))
+        download = Download(None, "error", None)
+        start = time.monotonic()
+        metrics.add("in_flight", 1)
+        try:
+            download = download_image(counter, url, sha256, (args.connect_timeout, args.read_timeout), args.tmpdir, args.max_size,
+                                      args.deadline or None, http_cache.get(url) if http_cache is not None else None)
+        finally:
+            metrics.add("in_flight", -1)
+            record_download(counter, url, download, time.monotonic() - start)
+            if dead_links is not None:
+                dead_links.record(url, download.status)
+            delay = scheduler.done((url, sha256, faces), download.status, download.retry_after)
+        if delay is not None:
+            logger.info("Line {number}: Retrying in {delay:.1f} seconds: {url}".format(number=counter, delay=delay, url=url), extra=line_fields(counter, url))
+            return None
+        return finish_download((url, sha256, faces), download, manifest, args, crop_pool, shard_writer, blob_cache, http_cache)
+
+    def _worker(args):
+        results = collections.Counter()
+        while True:
+            job = scheduler.wait_job()
+            if job is None:
+                return results
+            try:
+                saved = _f(*job, args)
+            except Exception as e:  # Keep the worker alive for the remaining jobs
+                logger.error("Line {number}: {error}: {url}".format(number=job[2][0][0], error=e, url=job[0]), extra=line_fields(job[2][0][0], job[0]))
+                saved = False
+            if saved is not None:  # None if the job will be retried
+                results["saved" if saved else "failed"] += 1
+                metrics.inc("images_total", result="saved" if saved else "failed")
+
+    results = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.number_of_thread) as executor:
+        futures = [executor.submit(_worker, args) for _ in range(args.number_of_thread)]
+        scheduler.feed(jobs)
+        for future in concurrent.futures.as_completed(futures):
+            results.update(future.result())
+    return results
+
+
+# Commands other than downloading, given as the first argument
+COMMANDS = {"merge": merge_main,
+            "verify": verify_main,
+            "repair": functools.partial(verify_main, repair=True),
+            "crop": crop_main,
+            "export": export_main}
+
+
+def main(argv=None, lines=None):
+    """Download the dataset. argv defaults to sys.argv[1:].
+    If lines is given, only faces on those line numbers of the data file are downloaded.
+    Returns a Counter of the number of images saved and failed.
+    If the first argument is one of COMMANDS, that command is run instead.
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(description="Script to download FaceScrub dataset",
+                                     epilog="Other commands: {}. Run with <command> --help for details".format(", ".join(sorted(COMMANDS))))
     parser.add_argument("inputfile", help="FaceScrub data file. E.g., actors_users_normal_bbox.txt", type=str)
     parser.add_argument("datasetpath", help="Directory to save images", type=str)
     parser.add_argument("--crop_face", help="Whether to crop and save face images", dest="crop_face", action="store_true", default=False)
-    parser.add_argument('-t', '--timeout', type=float, help="Number of seconds (float) to wait before requests timeout", action="store", required=False, dest="timeout", default=10)
+    parser.add_argument('-t', '--timeout', type=float, help="Number of seconds (float) to wait before requests timeout. Default for --connect_timeout and --read_timeout", action="store", required=False, dest="timeout", default=10)
+    parser.add_argument('--connect_timeout', type=float, help="Number of seconds (float) to wait for a connection to a host",
+                        action="store", required=False, dest="connect_timeout", default=None)
+    parser.add_argument('--read_timeout', type=float, help="Number of seconds (float) to wait for each read from a host",
+                        action="store", required=False, dest="read_timeout", default=None)
+    parser.add_argument('--deadline', type=float, help="Most seconds (float) a download may take in total, including redirects. 0 for no limit",
+                        action="store", required=False, dest="deadline", default=60)
     parser.add_argument('-r', '--max_retries', type=int, help="Maximum number of retries before giving up", action="store", required=False, dest="max_retries", default=1)
     parser.add_argument('-l', '--logfile', type=str, help="File to log operations", action="store", required=False, dest="logfile", default="download.log")
     parser.add_argument('-s', '--start_at_line', type=int, help="Line number in FaceScrub data file to start download. Note: Header counts as 1 line",
@@ -308,13 +3022,101 @@ def main():
                         action="store", required=False, dest="end_at_line", default=0)
     parser.add_argument('-n', '--number_of_thread', type=int, help="Number of threads run in thread poll when fetching data",
                         action="store", required=False, dest="number_of_thread", default=10)
-    args = parser.parse_args()
+    parser.add_argument('--engine', type=str, help="Download using a thread pool or an asyncio event loop (requires aiohttp)",
+                        action="store", required=False, dest="engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument('-c', '--concurrency', type=int, help="Number of concurrent downloads when using --engine=asyncio",
+                        action="store", required=False, dest="concurrency", default=100)
+    parser.add_argument('--max_per_host', type=int, help="Maximum number of simultaneous downloads from the same host",
+                        action="store", required=False, dest="max_per_host", default=2)
+    parser.add_argument('--rate_per_host', type=float, help="Maximum number of requests per second (float) to the same host. 0 for no limit",
+                        action="store", required=False, dest="rate_per_host", default=2)
+    parser.add_argument('--max_queued', type=int, help="Maximum number of parsed images waiting to be downloaded",
+                        action="store", required=False, dest="max_queued", default=10000)
+    parser.add_argument('--max_pending_saves', type=int, help="Maximum number of downloaded images waiting to be saved when using --engine=asyncio",
+                        action="store", required=False, dest="max_pending_saves", default=32)
+    parser.add_argument('--max_size', type=float, help="Maximum image size in megabytes (float). Larger downloads are aborted",
+                        action="store", required=False, dest="max_size", default=20)
+    parser.add_argument('--retry_attempts', type=int, help="Number of times to retry a timeout, connection error or HTTP 429/5xx later with backoff",
+                        action="store", required=False, dest="retry_attempts", default=3)
+    add_crop_arguments(parser)
+    parser.add_argument('--crop_workers', type=int, help="Number of processes that crop faces. 0 to crop on the download threads. Default: number of CPUs",
+                        action="store", required=False, dest="crop_workers", default=os.cpu_count() or 1)
+    parser.add_argument('--max_pending_crops', type=int, help="Maximum number of images waiting to have their faces cropped. Downloads wait while there are more",
+                        action="store", required=False, dest="max_pending_crops", default=64)
+    parser.add_argument('--output', type=str, help="Save one file per image, or pack images and faces into tar shards with an offset index",
+                        action="store", required=False, dest="output", choices=["files", "shards"], default="files")
+    parser.add_argument('--shard_size', type=float, help="Size in megabytes (float) after which a new shard is started when using --output=shards",
+                        action="store", required=False, dest="shard_size", default=1024)
+    parser.add_argument('--progress_interval', type=float, help="Seconds (float) between progress summaries in the log. 0 to disable",
+                        action="store", required=False, dest="progress_interval", default=10)
+    parser.add_argument('--metrics_file', type=str, help="File to write metrics to in Prometheus text format, updated every progress_interval",
+                        action="store", required=False, dest="metrics_file", default=None)
+    parser.add_argument('--log_format', type=str, help="Format of the log file. json writes one record per line with fields such as line, url, status and duration",
+                        action="store", required=False, dest="log_format", choices=["text", "json"], default="text")
+    parser.add_argument('--num_parts', type=int, help="Split the images into this many parts, e.g. one per machine, by a stable hash of their sha256",
+                        action="store", required=False, dest="num_parts", default=1)
+    parser.add_argument('--part_index', type=int, help="Which part (0 to num_parts - 1) to download on this machine",
+                        action="store", required=False, dest="part_index", default=0)
+    parser.add_argument('--cache_dir', type=str, help="Directory of a cache of images keyed by sha256, shared between runs. Images found there are not downloaded",
+                        action="store", required=False, dest="cache_dir", default=None)
+    parser.add_argument('--cache_size', type=float, help="Maximum size of the cache in megabytes (float). Least recently used images are removed first",
+                        action="store", required=False, dest="cache_size", default=20480)
+    parser.add_argument('--dead_host_failures', type=int, help="Give up on a host for the rest of the run after this many of its urls time out or fail to connect in a row. 0 to never give up",
+                        action="store", required=False, dest="dead_host_failures", default=5)
+    parser.add_argument('--dead_link_expiry', type=float, help="Days (float) to remember urls that returned 404 or 410, so they are skipped",
+                        action="store", required=False, dest="dead_link_expiry", default=7)
+    parser.add_argument('--dns_ttl', type=float, help="Seconds (float) to cache the address of a host. 0 to look it up for every connection",
+                        action="store", required=False, dest="dns_ttl", default=300)
+    parser.add_argument('--names', type=str, help="Only download images of these people, separated by commas, as named in the data file. E.g., \"Aaron Eckhart,Adam Brody\"",
+                        action="store", required=False, dest="names", default=None)
+    parser.add_argument('--hosts', type=str, help="Only download images from these hosts, separated by commas. E.g., upload.wikimedia.org",
+                        action="store", required=False, dest="hosts", default=None)
+    parser.add_argument('--sample', type=int, help="Only download this many faces, picked at random from those selected",
+                        action="store", required=False, dest="sample", default=None)
+    parser.add_argument('--order', type=str, help="Download images in data file order, in random order, or taking one image from each host in turn",
+                        action="store", required=False, dest="order", choices=["file", "shuffle", "hosts"], default="file")
+    parser.add_argument('--seed', type=int, help="Seed for --sample and --order=shuffle, to pick the same images again",
+                        action="store", required=False, dest="seed", default=None)
+    parser.add_argument('--redownload', help="Download all lines again, even those recorded as done in datasetpath/manifest.sqlite",
+                        dest="redownload", action="store_true", default=False)
+    args = parser.parse_args(argv)
 
     assert args.timeout > 0, "timeout must be > 0"
+    if args.connect_timeout is None:
+        args.connect_timeout = args.timeout
+    if args.read_timeout is None:
+        args.read_timeout = args.timeout
+    assert args.connect_timeout > 0, "connect_timeout must be > 0"
+    assert args.read_timeout > 0, "read_timeout must be > 0"
+    assert args.deadline >= 0, "deadline must be >= 0"
     assert args.max_retries >= 1, "max_retries must be >= 1"
     assert args.start_at_line >= 1, "start_at_line must be >= 1"
     assert args.end_at_line >= 0, "end_at_line must be >= 0"
     assert args.number_of_thread >= 1, "number_of_thread must be >= 1"
+    assert args.concurrency >= 1, "concurrency must be >= 1"
+    assert args.max_per_host >= 1, "max_per_host must be >= 1"
+    assert args.rate_per_host >= 0, "rate_per_host must be >= 0"
+    assert args.max_queued >= 1, "max_queued must be >= 1"
+    assert args.max_pending_saves >= 1, "max_pending_saves must be >= 1"
+    assert args.max_size > 0, "max_size must be > 0"
+    assert args.retry_attempts >= 0, "retry_attempts must be >= 0"
+    assert args.crop_workers >= 0, "crop_workers must be >= 0"
+    assert args.max_pending_crops >= 1, "max_pending_crops must be >= 1"
+    assert args.shard_size > 0, "shard_size must be > 0"
+    assert args.progress_interval >= 0, "progress_interval must be >= 0"
+    assert args.num_parts >= 1, "num_parts must be >= 1"
+    assert 0 <= args.part_index < args.num_parts, "part_index must be >= 0 and < num_parts"
+    assert args.cache_size > 0, "cache_size must be > 0"
+    assert args.dead_host_failures >= 0, "dead_host_failures must be >= 0"
+    assert args.dead_link_expiry >= 0, "dead_link_expiry must be >= 0"
+    assert args.dns_ttl >= 0, "dns_ttl must be >= 0"
+    assert args.sample is None or args.sample >= 0, "sample must be >= 0"
+    if args.names is not None:
+        args.names = [name.strip() for name in args.names.split(',') if name.strip()]
+    if args.hosts is not None:
+        args.hosts = [host.strip() for host in args.hosts.split(',') if host.strip()]
+    args.max_size = int(args.max_size * 1024 * 1024)  # In bytes
+    args.crop_options = parse_crop_arguments(args)
 
     end_at_line = None                  # Process until end of file
     if args.end_at_line > 0:
@@ -322,10 +3124,17 @@ def main():
 
     start_at_line = args.start_at_line - 1  # Index starts at 0
 
-    create_logger(args.logfile)
+    create_logger(args.logfile, args.log_format)
     logger = logging.getLogger("logger")
-    setup_session(args.max_retries)
-
+    metrics.reset()  # main may run more than once in a process, e.g. for repair
+    if args.engine == "asyncio" and not has_aiohttp_lib:
+        logger.error("--engine=asyncio requires aiohttp. Install it with: pip install aiohttp")
+        return
+    # The scheduler never runs more than max_per_host downloads from a host, so
+    # that many connections per host are enough. Connections are kept for more
+    # hosts than there are threads, as the scheduler goes round all the hosts.
+    setup_session(args.max_retries, pool_hosts=max(10, 4 * args.number_of_thread),
+                  pool_size=min(args.max_per_host, args.number_of_thread))
     print("")
     print('=' * 30)
     print("Start processing from line: {}".format(args.start_at_line))
@@ -343,18 +3152,96 @@ def main():
         logger.error("{}".format(e))
         return
 
-    def _f(counter, line, args):
-        name, image_id, face_id, url, bbox, sha256 = parse_line(line)
-        logger.info("Processing line {}: {}".format(counter, url))
-        response = download_image(counter, url, sha256, args.timeout)
-        if response:
-            save_image(counter, url, response, args.datasetpath, name.replace(' ', '_'), image_id, face_id, bbox, save_face=args.crop_face)
+    # Downloads are streamed to this directory before being moved into place.
+    # Start it empty, as runs that were killed leave partial downloads in it.
+    args.tmpdir = os.path.join(args.datasetpath, ".tmp")
+    shutil.rmtree(args.tmpdir, ignore_errors=True)
+    ensure_dir_exists(args.tmpdir)
+
+    # Records every line so that reruns only download what is missing
+    manifest = Manifest(args.datasetpath)
+
+    with infile:
+        # Load the lines to download and select, group and order them all at once
+        start = time.monotonic()
+        data = DataFile(enumerate(islice(infile, start_at_line, end_at_line), start_at_line + 1))
+        rows = data.select(args.names, args.hosts, args.sample, args.seed)
+        if lines is not None:
+            rows = [row for row in rows if data.lines[row] in lines]
+        jobs = data.plan(rows, args.order, args.seed)
+        logger.info("Selected {} faces out of {} in {:.0f} ms".format(len(rows), len(data), (time.monotonic() - start) * 1000))
+        if args.num_parts > 1:
+            jobs = select_partition(jobs, args.part_index, args.num_parts)
+        if not args.redownload:
+            jobs = manifest.skip_done(jobs, need_face=args.crop_face)
+
+        # Images downloaded before, possibly for another data file or dataset directory
+        blob_cache = None
+        if args.cache_dir is not None:
+            blob_cache = BlobCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+
+        # Urls and hosts that failed before fail again without a request
+        dead_links = DeadLinks(args.datasetpath, args.dead_host_failures, args.dead_link_expiry * 24 * 3600)
+
+        # Validators and redirects of urls downloaded before, to ask servers only for images that changed
+        http_cache = HttpCache(args.datasetpath)
+
+        def is_local(url, sha256):
+            return (blob_cache is not None and sha256 in blob_cache) or dead_links.check(url) is not None
+
+        # Interleaves hosts so that no single site gets all the requests. Jobs that need no request skip the queues of their hosts.
+        scheduler = HostScheduler(args.max_per_host, args.rate_per_host, args.max_queued, args.retry_attempts, is_local)
+        metrics.gauge("queued_jobs", lambda: len(scheduler.pending))
+        metrics.gauge("delayed_jobs", lambda: len(scheduler.delayed))
+
+        reporter = None
+        stop_reporter = threading.Event()
+        if args.progress_interval > 0:
+            reporter = threading.Thread(target=report_progress, args=(stop_reporter, args.progress_interval, args.metrics_file),
+                                        daemon=True)
+            reporter.start()
+
+        # Cropping is CPU bound, so it runs in separate processes while threads do the downloading
+        crop_pool = None
+        if args.crop_face and args.crop_workers > 0:
+            crop_pool = CropQueue(args.crop_workers, args.max_pending_crops)
+
+        shard_writer = None
+        if args.output == "shards":
+            shard_writer = ShardWriter(args.datasetpath, int(args.shard_size * 1024 * 1024))
+
+        dns_cache = None
+        if args.dns_ttl > 0 and args.engine == "thread":  # aiohttp has its own cache
+            dns_cache = DnsCache(args.dns_ttl)
+            dns_cache.install()
+
+        try:
+            if args.engine == "asyncio":
+                results = asyncio.run(run_async(scheduler, jobs, manifest, args, crop_pool, shard_writer, blob_cache, dead_links,
+                                              http_cache))
+            else:
+                results = run_threads(scheduler, jobs, manifest, args, crop_pool, shard_writer, blob_cache, dead_links, http_cache)
+        finally:
+            if crop_pool is not None:
+                crop_pool.shutdown()
+            if shard_writer is not None:
+                shard_writer.close()
+            if reporter is not None:
+                stop_reporter.set()
+                reporter.join()
+            if dns_cache is not None:
+                dns_cache.uninstall()
+
+    if blob_cache is not None:
+        blob_cache.close()
+    http_cache.close()
+    dead_links.close()
+    manifest.close()
+    shutil.rmtree(args.tmpdir, ignore_errors=True)
+    logger.info(metrics.summary())
+    logger.info("Finished: {} images saved, {} failed".format(results["saved"], results["failed"]))
+    return results
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.number_of_thread) as executor:
-        futures = []
-        for counter, line in enumerate(islice(infile,start_at_line,end_at_line), start_at_line+1):
-            future = executor.submit(_f, counter, line, args)
-            futures.append(future)
 
 if __name__ == "__main__":
     main()